@@ -0,0 +1,300 @@
+"""Benchmarks for the BirdNET audio hot path in lambda_function.py.
+
+Run from this directory:
+
+    python benchmark.py --stub batch [--minutes 1 10 30]
+    python benchmark.py stream [--minutes 1 10 30]
+    python benchmark.py resample [--rates 44100 22050 32000]
+    python benchmark.py gate [--folder path/to/recordings]
+
+--stub generates a small TFLite model with BirdNET's input and output shapes
+and a dynamic batch dimension, so no model download (or AWS access) is
+needed. Without it the real model and labels are fetched from S3 as the
+Lambda does. stream and resample never load a model.
+"""
+import argparse
+import glob
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import soundfile as sf
+import tensorflow as tf
+from scipy.signal import lfilter, resample
+
+import lambda_function
+from lambda_function import AudioProcessor, BirdNETPredictor
+
+NUM_STUB_LABELS = 6522
+
+
+def make_stub_model(path, num_classes, segment_samples):
+    """Pooled strided convolution plus a dense head: (N, segment_samples) -> (N, num_classes)"""
+    inputs = tf.keras.Input(shape=(segment_samples,), name="input")
+    x = tf.keras.layers.Reshape((segment_samples, 1))(inputs)
+    x = tf.keras.layers.Conv1D(16, 512, strides=256, activation="relu")(x)
+    x = tf.keras.layers.GlobalAveragePooling1D()(x)
+    outputs = tf.keras.layers.Dense(num_classes, activation="sigmoid")(x)
+    model = tf.keras.Model(inputs, outputs)
+
+    with open(path, "wb") as f:
+        f.write(tf.lite.TFLiteConverter.from_keras_model(model).convert())
+
+
+def use_stub_model(predictor, tmp_dir):
+    predictor.model_path = os.path.join(tmp_dir, "stub.tflite")
+    predictor.labels_path = os.path.join(tmp_dir, "labels.txt")
+    make_stub_model(predictor.model_path, NUM_STUB_LABELS, int(predictor.sample_rate * predictor.segment_length))
+    with open(predictor.labels_path, "w") as f:
+        f.writelines(f"Genus species_Bird {i}\n" for i in range(NUM_STUB_LABELS))
+    # Files are already in place, so nothing is downloaded
+    predictor._model_loaded = True
+
+
+def add_chirps(audio, sample_rate, count, rng):
+    """Add count half-second 3-7 kHz sweeps at random positions"""
+    t = np.arange(sample_rate // 2) / sample_rate
+    chirp = (0.5 * np.sin(2 * np.pi * (3000 + 4000 * t) * t)).astype(audio.dtype)
+    for start in rng.integers(0, len(audio) - len(chirp), max(1, count)):
+        audio[start:start + len(chirp)] += chirp
+    return audio
+
+
+def make_recording(minutes, sample_rate, seed=0):
+    """Noise with a few chirps at sample_rate"""
+    rng = np.random.default_rng(seed)
+    audio = rng.normal(0, 0.02, int(minutes * 60 * sample_rate)).astype(np.float32)
+    return add_chirps(audio, sample_rate, int(minutes * 20), rng)
+
+
+def same_predictions(a, b):
+    key = lambda p: (p["segment"], p["species"])
+    a, b = sorted(a, key=key), sorted(b, key=key)
+    return len(a) == len(b) and all(
+        key(x) == key(y) and abs(x["confidence"] - y["confidence"]) < 1e-4 for x, y in zip(a, b)
+    )
+
+
+def bench_batch(args, predictor):
+    predictor.ensure_loaded()
+    print(f"{'minutes':>8} {'segments':>9} {'batch':>6} {'seg/s':>9} {'speedup':>8} {'match':>6}")
+    for minutes in args.minutes:
+        audio = make_recording(minutes, predictor.sample_rate)
+        segments = list(AudioProcessor.segment_audio(audio, predictor.sample_rate, predictor.segment_length))
+
+        baseline = None
+        for batch_size in args.batch_sizes:
+            predictor.predict(segments[:batch_size], batch_size=batch_size, gate=False)
+            start = time.perf_counter()
+            results = predictor.predict(segments, batch_size=batch_size, gate=False)
+            rate = len(segments) / (time.perf_counter() - start)
+
+            if baseline is None:
+                baseline = (rate, results)
+            match = same_predictions(baseline[1], results)
+            print(f"{minutes:>8g} {len(segments):>9} {batch_size:>6} {rate:>9.1f} "
+                  f"{rate / baseline[0]:>7.1f}x {str(match):>6}")
+    if not predictor._batching_supported:
+        print("Model has a fixed batch dimension, every run used one segment per invoke")
+
+
+def peak_kb(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, peak / 1024, elapsed
+
+
+def bench_stream(args, predictor):
+    sr = predictor.sample_rate
+    print(f"{'minutes':>8} {'segments':>9} {'whole KB':>10} {'whole s':>8} {'stream KB':>10} {'stream s':>9} {'match':>6}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for minutes in args.minutes:
+            path = os.path.join(tmp_dir, f"{minutes}.wav")
+            sf.write(path, make_recording(minutes, args.source_rate), args.source_rate)
+
+            def whole():
+                audio, _ = AudioProcessor.load_audio(path, sr)
+                return list(AudioProcessor.segment_audio(audio, sr, predictor.segment_length))
+
+            def stream():
+                # Keep one float per segment, as a consumer that does not hold on to audio would
+                blocks = AudioProcessor.stream_audio(path, sr)
+                return [float(np.abs(segment).mean())
+                        for segment in AudioProcessor.stream_segments(blocks, sr, predictor.segment_length)]
+
+            segments, whole_kb, whole_s = peak_kb(whole)
+            levels, stream_kb, stream_s = peak_kb(stream)
+            match = len(levels) == len(segments) and np.allclose(levels, np.abs(segments).mean(axis=1), rtol=1e-2)
+            print(f"{minutes:>8g} {len(segments):>9} {whole_kb:>10.0f} {whole_s:>8.2f} "
+                  f"{stream_kb:>10.0f} {stream_s:>9.2f} {str(match):>6}")
+
+
+def legacy_resample(audio, sr, target_sr):
+    """What load_audio used to do: one FFT resample of the whole signal"""
+    return resample(audio, int(len(audio) / sr * target_sr)).astype(np.float32)
+
+
+def snr_db(reference, audio):
+    noise = np.sum((reference - audio) ** 2)
+    return float("inf") if noise == 0 else 10 * np.log10(np.sum(reference ** 2) / noise)
+
+
+def tones(num_samples, sr, freqs=(1234.5, 3000.3, 5000.7, 8100.1)):
+    """Bird-band tones, which can be generated exactly at any rate to serve as ground truth"""
+    t = np.arange(num_samples) / sr
+    return sum(np.sin(2 * np.pi * f * t) for f in freqs).astype(np.float32) / len(freqs)
+
+
+def bench_resample(args, predictor):
+    target_sr = predictor.sample_rate
+    print(f"{'rate':>6} {'samples':>9} {'fft ms':>9} {'poly ms':>9} {'stream ms':>10} "
+          f"{'fft dB':>7} {'stream dB':>10} {'vs fft dB':>10} {'vs whole dB':>12}")
+    for rate in args.rates:
+        for seconds in args.seconds:
+            # One sample short of a round length, the kind that makes the FFT path slow
+            audio = tones(int(seconds * rate) - 1, rate)
+            blocksize = int(lambda_function.STREAM_BLOCK_SECONDS * rate)
+
+            def stream():
+                resampler = lambda_function.StreamResampler(rate, target_sr)
+                parts = [resampler.process(audio[i:i + blocksize]) for i in range(0, len(audio), blocksize)]
+                return np.concatenate(parts + [resampler.flush()])
+
+            legacy = legacy_resample(audio, rate, target_sr)
+            whole = lambda_function.resample_audio(audio, rate, target_sr)[:len(legacy)]
+            streamed = stream()
+            assert len(streamed) == len(legacy), (len(streamed), len(legacy))
+
+            # Edges are treated differently (periodic vs zero padded), so compare away from them.
+            # dB columns are SNR against the tones generated at target_sr, then the two
+            # paths against each other
+            edge = target_sr // 10
+            inner = slice(edge, len(legacy) - edge)
+            ideal = tones(len(legacy), target_sr)[inner]
+            fft_ms = time_call(lambda: legacy_resample(audio, rate, target_sr), args.repeat)
+            poly_ms = time_call(lambda: lambda_function.resample_audio(audio, rate, target_sr), args.repeat)
+            stream_ms = time_call(stream, args.repeat)
+            print(f"{rate:>6} {len(audio):>9} {fft_ms:>9.1f} {poly_ms:>9.1f} {stream_ms:>10.1f} "
+                  f"{snr_db(ideal, legacy[inner]):>7.1f} {snr_db(ideal, streamed[inner]):>10.1f} "
+                  f"{snr_db(legacy[inner], streamed[inner]):>10.1f} {snr_db(whole, streamed):>12.1f}")
+
+
+def time_call(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return np.median(timings) * 1000
+
+
+def make_field_recording(minutes, sr, seed=0):
+    """Mostly near-silence and low-frequency wind, with the odd chirp, like an unattended recorder"""
+    rng = np.random.default_rng(seed)
+    audio = rng.normal(0, 1e-4, int(minutes * 60 * sr))
+    gust = int(10 * sr)
+    for start in rng.integers(0, len(audio) - gust, max(1, int(minutes))):
+        wind = lfilter([1], [1, -0.999], rng.normal(0, 1, gust))
+        audio[start:start + gust] += 0.1 * wind / np.abs(wind).max()
+    return add_chirps(audio, sr, int(minutes * 4), rng).astype(np.float32)
+
+
+def gate_recordings(args, predictor):
+    """(name, segments) for each file in --folder, or for generated field recordings"""
+    sr, length, overlap = predictor.sample_rate, predictor.segment_length, predictor.segment_overlap
+    if not args.folder:
+        for seed in range(args.recordings):
+            audio = make_field_recording(args.minutes, sr, seed)
+            yield f"synthetic-{seed}", list(AudioProcessor.segment_audio(audio, sr, length, overlap))
+        return
+
+    paths = sorted(
+        path for path in glob.glob(os.path.join(args.folder, "*"))
+        if path.lower().endswith((".wav", ".flac", ".ogg", ".mp3"))
+    )
+    if not paths:
+        raise SystemExit(f"No recordings found in {args.folder}")
+    for path in paths:
+        blocks = AudioProcessor.stream_audio(path, sr)
+        yield os.path.basename(path), list(AudioProcessor.stream_segments(blocks, sr, length, overlap))
+
+
+def bench_gate(args, predictor):
+    """Detections the energy gate would have lost, per threshold pair.
+
+    The model runs once on every segment with the gate off; each threshold
+    pair is then applied to the measured levels. A detection counts as lost
+    when its most confident window would have been skipped.
+    """
+    predictor.ensure_loaded()
+    files = []
+    for name, segments in gate_recordings(args, predictor):
+        levels = np.array([lambda_function.segment_levels(s, predictor.sample_rate) for s in segments]).reshape(-1, 2)
+        predictions = predictor.predict(segments, args.threshold, gate=False)
+        files.append((levels, predictions))
+        print(f"{name}: {len(segments)} segments, {len(predictions)} detections")
+
+    total_segments = sum(len(levels) for levels, _ in files)
+    total_detections = sum(len(predictions) for _, predictions in files)
+    print(f"\n{'rms dB':>7} {'band dB':>8} {'skipped':>8} {'lost':>6} {'lost %':>7} {'species lost':>13}")
+    for rms_db in args.rms_db:
+        for band_db in args.band_db:
+            skipped = lost = species_lost = 0
+            for levels, predictions in files:
+                kept = (levels[:, 0] >= rms_db) & (levels[:, 1] >= band_db)
+                skipped += int((~kept).sum())
+                lost += sum(not kept[p["segment"]] for p in predictions)
+                found = {p["species"] for p in predictions}
+                species_lost += len(found - {p["species"] for p in predictions if kept[p["segment"]]})
+            print(f"{rms_db:>7g} {band_db:>8g} {skipped / max(1, total_segments):>7.1%} {lost:>6} "
+                  f"{lost / max(1, total_detections):>6.1%} {species_lost:>13}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stub", action="store_true", help="Use a generated stub model instead of S3")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    batch = subparsers.add_parser("batch", help="Segments/sec for per-segment vs batched inference")
+    batch.add_argument("--minutes", type=float, nargs="+", default=[1, 10, 30])
+    batch.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, lambda_function.BATCH_SEGMENTS])
+    batch.set_defaults(func=bench_batch)
+
+    stream = subparsers.add_parser("stream", help="Peak memory of whole-file vs streamed decoding")
+    stream.add_argument("--minutes", type=float, nargs="+", default=[1, 10, 30])
+    stream.add_argument("--source-rate", type=int, default=44100)
+    stream.set_defaults(func=bench_stream)
+
+    resample_cmd = subparsers.add_parser("resample", help="FFT vs polyphase vs streamed polyphase resampling")
+    resample_cmd.add_argument("--rates", type=int, nargs="+", default=[44100, 22050, 32000])
+    resample_cmd.add_argument("--seconds", type=float, nargs="+", default=[10, 60, 300])
+    resample_cmd.add_argument("--repeat", type=int, default=3)
+    resample_cmd.set_defaults(func=bench_resample)
+
+    gate = subparsers.add_parser("gate", help="Segments skipped vs detections lost per energy gate threshold")
+    gate.add_argument("--folder", help="Recordings to evaluate; generated field recordings if omitted")
+    gate.add_argument("--recordings", type=int, default=3)
+    gate.add_argument("--minutes", type=float, default=5)
+    gate.add_argument("--threshold", type=float, default=0.1)
+    gate.add_argument("--rms-db", type=float, nargs="+", default=[-90, -80, -70, -60, -50])
+    gate.add_argument("--band-db", type=float, nargs="+", default=[-90, -80, -70, -60])
+    gate.set_defaults(func=bench_gate)
+
+    args = parser.parse_args()
+    predictor = BirdNETPredictor()
+    if args.stub:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            use_stub_model(predictor, tmp_dir)
+            args.func(args, predictor)
+    else:
+        args.func(args, predictor)
+
+
+if __name__ == "__main__":
+    main()
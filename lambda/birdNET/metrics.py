@@ -0,0 +1,102 @@
+"""Per-stage timings for Lambda handlers as CloudWatch Embedded Metric Format.
+
+Each invocation (or each record of a batched one) gets a StageTimer. Named
+stages are timed with `with timer.stage("download"):` and emitted as one EMF
+JSON line on stdout when the invocation ends. CloudWatch turns that line
+into metrics, so latency per stage can be graphed and queried from the logs
+alone, without a metrics API call on the hot path. Locally the line is just
+printed.
+
+Every line carries the handler name, whether this was the container's first
+invocation (cold start), and any properties the handler adds, such as the
+model version or payload size. This file is shared by all the Lambdas, with
+one copy in each of their directories, like model_store.py.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+
+NAMESPACE = os.environ.get("METRICS_NAMESPACE", "BirdTagging")
+ENABLED = os.environ.get("METRICS", "1") == "1"
+
+_cold_start = True
+_cold_start_lock = threading.Lock()
+
+
+def _take_cold_start():
+    global _cold_start
+    with _cold_start_lock:
+        cold, _cold_start = _cold_start, False
+    return cold
+
+
+class StageTimer:
+    def __init__(self, handler, **properties):
+        self.handler = handler
+        self.cold_start = _take_cold_start()
+        self.stages = {}
+        self.values = {}
+        self.properties = dict(properties)
+        self._start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time a block as a named stage; repeated stages add up"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - start) * 1000)
+
+    def add(self, name, ms):
+        self.stages[name] = self.stages.get(name, 0.0) + ms
+
+    def value(self, name, value, unit="Count"):
+        """A non-timing metric, e.g. value("payload_bytes", n, "Bytes")"""
+        self.values[name] = (value, unit)
+
+    def set(self, **properties):
+        """Searchable context that is not a metric, e.g. the model version"""
+        self.properties.update(properties)
+
+    def document(self):
+        metrics = {f"{name}_ms": round(ms, 2) for name, ms in self.stages.items()}
+        metrics["total_ms"] = round((time.perf_counter() - self._start) * 1000, 2)
+        units = {name: "Milliseconds" for name in metrics}
+        for name, (value, unit) in self.values.items():
+            metrics[name] = value
+            units[name] = unit
+
+        return {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": NAMESPACE,
+                    "Dimensions": [["Handler"], ["Handler", "ColdStart"]],
+                    "Metrics": [{"Name": name, "Unit": unit} for name, unit in units.items()],
+                }],
+            },
+            "Handler": self.handler,
+            "ColdStart": "true" if self.cold_start else "false",
+            **self.properties,
+            **metrics,
+        }
+
+    def emit(self):
+        if ENABLED:
+            print(json.dumps(self.document(), default=str), flush=True)
+
+
+@contextlib.contextmanager
+def invocation(handler, **properties):
+    """StageTimer for one invocation, emitted when the block exits, failed or not"""
+    timer = StageTimer(handler, **properties)
+    try:
+        yield timer
+    except Exception as e:
+        timer.set(error=type(e).__name__)
+        raise
+    finally:
+        timer.emit()
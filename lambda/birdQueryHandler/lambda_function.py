@@ -1,11 +1,18 @@
 import json
+import os
+import time
 import boto3
+from botocore.exceptions import ClientError
 from decimal import Decimal
+from metrics import invocation
 
 TABLE_NAME = "BirdTagsData"
 dynamodb = boto3.resource("dynamodb")
 table = dynamodb.Table(TABLE_NAME)
 s3 = boto3.client("s3")
+lambda_client = boto3.client("lambda")
+# Renders annotated copies of files ingested without eager annotation
+RENDER_FUNCTION = os.environ.get("ANNOTATION_RENDER_FUNCTION", "birdTagLambda")
 
 
 class DecimalEncoder(json.JSONEncoder):
@@ -15,6 +22,40 @@ class DecimalEncoder(json.JSONEncoder):
         return super(DecimalEncoder, self).default(obj)
 
 
+def is_rendered(s3_uri):
+    bucket, key = s3_uri.replace("s3://", "").split("/", 1)
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+
+def open_annotated(s3_uri, timer):
+    """Render one lazily annotated file, if it has not been already, and presign it"""
+    if not s3_uri.startswith("s3://") or not s3_uri.replace("s3://", "").split("/", 1)[-1].startswith("annotated/"):
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"error": "Invalid 'annotated' parameter"})
+        }
+
+    with timer.stage("render"):
+        response = lambda_client.invoke(
+            FunctionName=RENDER_FUNCTION,
+            Payload=json.dumps({"action": "render", "annotated_s3_url": s3_uri}).encode("utf-8")
+        )
+        payload = json.loads(response["Payload"].read())
+    if payload.get("statusCode") != 200:
+        print(f"Rendering {s3_uri} failed: {payload}")
+        return {
+            "statusCode": 502,
+            "body": json.dumps({"error": "Rendering failed"})
+        }
+    return {"statusCode": 200, "body": payload["body"]}
+
+
 def parse_get_filters(params):
     filters = {}
     index = 1
@@ -70,6 +111,18 @@ def parse_post_filters(body_raw):
 
 
 def lambda_handler(event, context):
+    with invocation("birdQueryHandler") as timer:
+        params = event.get("queryStringParameters") or {}
+        if event.get("httpMethod", "").upper() == "GET" and "annotated" in params:
+            # The render_request of a pending search result: the user opened that file
+            response = open_annotated(params["annotated"], timer)
+        else:
+            response = search_by_tags(event, timer)
+        timer.set(status_code=response["statusCode"])
+        return response
+
+
+def search_by_tags(event, timer):
     try:
         method = event.get("httpMethod", "").upper()
         if method not in ("GET", "POST"):
@@ -93,7 +146,9 @@ def lambda_handler(event, context):
             }
 
         # === Scan DynamoDB ===
-        response = table.scan()
+        with timer.stage("dynamodb"):
+            response = table.scan()
+        timer.value("scanned_items", len(response.get("Items", [])))
         matching_results = []
 
         for item in response.get("Items", []):
@@ -128,11 +183,19 @@ def lambda_handler(event, context):
                 result_item = dict(item)  # Clone the item to avoid modifying original
 
                 # Generate presigned URLs for all three S3 fields
+                presign_start = time.perf_counter()
                 for field in ["annotated_s3_url", "original_s3_url", "thumbnail_s3_url"]:
                     uri = item.get(field)
                     url_field = field.replace("_s3_url", "_url")
                     if uri and uri.startswith("s3://"):
                         try:
+                            # Searches never render: an unrendered lazy file is marked pending,
+                            # with the request that renders it when the user opens it
+                            if field == "annotated_s3_url" and item.get("annotation") == "lazy" and not is_rendered(uri):
+                                result_item[url_field] = None
+                                result_item["annotation_status"] = "pending"
+                                result_item["render_request"] = {"annotated": uri}
+                                continue
                             bucket, key = uri.replace("s3://", "").split("/", 1)
                             presigned = s3.generate_presigned_url(
                                 "get_object",
@@ -146,7 +209,9 @@ def lambda_handler(event, context):
                     else:
                         result_item[url_field] = None
 
+                timer.add("presign", (time.perf_counter() - presign_start) * 1000)
                 matching_results.append(result_item)
+        timer.value("matched_files", len(matching_results))
 
         return {
             "statusCode": 200,
@@ -0,0 +1,81 @@
+"""Render annotated outputs from stored detection records.
+
+rerender.py uses this to redraw everything in bulk. The tagging Lambda uses
+it to annotate files ingested with EAGER_ANNOTATION=0 the first time they
+are asked for; the result is uploaded to the file's annotated key, so every
+later request finds it there.
+"""
+import io
+import os
+import tempfile
+
+import cv2
+from botocore.exceptions import ClientError
+
+import utils
+from detection_records import decode_detections, load_record, record_key
+
+
+def render_image(s3, record, threshold):
+    source = record["source"]
+    data = s3.get_object(Bucket=source["bucket"], Key=source["key"])["Body"].read()
+    detections = decode_detections(record["detections"], record["labels"], threshold)
+
+    buffer = io.BytesIO()
+    utils.draw_detections(utils.load_image(data), detections, buffer, copy=False)
+    buffer.seek(0)
+    return buffer
+
+
+def render_video(s3, record, threshold, tmp_dir):
+    source = record["source"]
+    _, ext = os.path.splitext(source["key"])
+    input_path = os.path.join(tmp_dir, "input" + ext)
+    output_path = os.path.join(tmp_dir, "annotated" + ext)
+    s3.download_file(source["bucket"], source["key"], input_path)
+
+    cap = cv2.VideoCapture(input_path)
+    out = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*"mp4v"), record["fps"], tuple(record["size"]))
+    try:
+        for columns in record["frames"]:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            out.write(utils.draw_detections_frame(frame, decode_detections(columns, record["labels"], threshold)))
+    finally:
+        cap.release()
+        out.release()
+    return output_path
+
+
+def render_record(s3, record, threshold=None, upload=True):
+    """Draw a record's detections onto its source file and upload the result over its annotated output"""
+    threshold = record["threshold"] if threshold is None else threshold
+    annotated = record["annotated"]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if record["kind"] == "image":
+            rendered = render_image(s3, record, threshold)
+            if upload:
+                s3.upload_fileobj(rendered, annotated["bucket"], annotated["key"])
+        else:
+            rendered_path = render_video(s3, record, threshold, tmp_dir)
+            if upload:
+                s3.upload_file(rendered_path, annotated["bucket"], annotated["key"])
+
+
+def object_exists(s3, bucket, key):
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404", "NotFound"):
+            return False
+        raise
+
+
+def ensure_annotated(s3, bucket, key):
+    """Render an annotated output from its record unless it already exists. Returns whether it was rendered"""
+    if object_exists(s3, bucket, key):
+        return False
+    render_record(s3, load_record(s3, bucket, record_key(key)))
+    return True
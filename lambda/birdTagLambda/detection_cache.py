@@ -0,0 +1,128 @@
+"""Content-addressed cache of detection results.
+
+Identical bytes always give the same detections for a given model, so
+results are keyed by the SHA-256 of the file plus the model version and
+variant that produced them. A new model version therefore never sees stale
+results, and the same photo uploaded again (by another user, or after a
+delete) skips inference in both the tagging and the query Lambdas.
+
+Lookups go through an in-process LRU first and then a persistent tier of
+JSON objects under an S3 prefix shared by all containers. Writes to the
+persistent tier are best effort: a role without write access still gets the
+in-process cache. Any client with get_object/put_object works as the S3
+client, which is how benchmark.py runs it against a local directory.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import boto3
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+CACHE_S3_BUCKET = os.environ.get("DETECTION_CACHE_BUCKET", "team99-uploaded-files")
+CACHE_S3_PREFIX = os.environ.get("DETECTION_CACHE_PREFIX", "detection-cache")
+CACHE_MAX_ENTRIES = int(os.environ.get("DETECTION_CACHE_ENTRIES", "256"))
+CACHE_ENABLED = os.environ.get("DETECTION_CACHE", "1") == "1"
+
+# Kinds of image results. Only full-pass results are the same whichever
+# Lambda produced them; the tagging Lambda's coarse-to-fine cascade can
+# differ from them, so its results are kept apart
+IMAGE_FULL = "image-full"
+IMAGE_CASCADE = "image-cascade"
+
+
+def content_hash(data):
+    """SHA-256 of raw file bytes"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def model_tag(model):
+    """Cache namespace of a LoadedModel: results differ between versions and variants"""
+    return f"{model.version}-{model.variant}"
+
+
+class DetectionCache:
+    def __init__(self, bucket=CACHE_S3_BUCKET, prefix=CACHE_S3_PREFIX, max_entries=CACHE_MAX_ENTRIES,
+                 enabled=CACHE_ENABLED, s3_client=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self._s3 = s3_client
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def s3(self):
+        # Lookups run on worker threads, and creating a client on the shared
+        # default session is not thread-safe
+        if self._s3 is None:
+            with self._lock:
+                if self._s3 is None:
+                    self._s3 = boto3.client("s3")
+        return self._s3
+
+    def _key(self, digest, tag, kind):
+        return f"{self.prefix}/{tag}/{kind}/{digest}.json"
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, digest, tag, kind):
+        """Cached result and the tier it came from ("memory" or "s3"), or (None, None) on a miss"""
+        if not self.enabled:
+            return None, None
+        key = self._key(digest, tag, kind)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key], "memory"
+
+        if not self.bucket:
+            return None, None
+        try:
+            obj = self.s3.get_object(Bucket=self.bucket, Key=key)
+            value = json.loads(obj["Body"].read())
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in ("NoSuchKey", "404", "AccessDenied"):
+                logger.warning(f"Detection cache lookup failed for {key}: {e}")
+            return None, None
+        except ValueError as e:
+            logger.warning(f"Ignoring unreadable detection cache entry {key}: {e}")
+            return None, None
+
+        self._remember(key, value)
+        return value, "s3"
+
+    def put(self, digest, tag, kind, value):
+        """Store a JSON-serialisable result in both tiers"""
+        if not self.enabled:
+            return
+        key = self._key(digest, tag, kind)
+        self._remember(key, value)
+        if not self.bucket:
+            return
+        try:
+            self.s3.put_object(Bucket=self.bucket, Key=key, Body=json.dumps(value).encode("utf-8"),
+                               ContentType="application/json")
+        except Exception as e:
+            logger.warning(f"Could not persist detection cache entry {key}: {e}")
+
+    def get_or_compute(self, data, tag, kind, compute):
+        """Result for file bytes, running compute() only on a miss. Returns (result, tier or None)"""
+        digest = content_hash(data)
+        value, tier = self.get(digest, tag, kind)
+        if tier is not None:
+            return value, tier
+        value = compute()
+        self.put(digest, tag, kind, value)
+        return value, None
@@ -0,0 +1,147 @@
+"""Compact per-file records of everything the detector found.
+
+Ingest writes one record next to each annotated output, at the annotated
+key plus RECORD_SUFFIX. It is gzipped JSON with detections stored as columns
+(boxes, class ids, confidences, and track ids for video), plus one entry per
+frame for videos. That is enough to redraw annotations, raise the confidence
+threshold or recount tags without running the model again (see
+rerender.py). Detections below the threshold used at ingest are never
+stored, so a threshold can only be raised, not lowered. Video records also
+keep the detector hits of each track ingest confirmed, so recounts apply
+the same minimum and never bring back tracks ingest dropped.
+"""
+import gzip
+import json
+from collections import Counter
+
+RECORD_FORMAT = 1
+RECORD_SUFFIX = ".detections.json.gz"
+
+
+def record_key(annotated_key):
+    return annotated_key + RECORD_SUFFIX
+
+
+def encode_detections(detections):
+    """Column form of a detection list, {} when there is nothing to store"""
+    if not detections:
+        return {}
+    columns = {
+        "boxes": [[round(float(v), 1) for v in d["bbox"]] for d in detections],
+        "class_ids": [int(d["class_id"]) for d in detections],
+        "confidences": [round(float(d["confidence"]), 4) for d in detections],
+    }
+    if any("track_id" in d for d in detections):
+        columns["track_ids"] = [d.get("track_id") for d in detections]
+    return columns
+
+
+def decode_detections(columns, labels, threshold=0.0):
+    """Detection dicts back from their column form, dropping those below threshold"""
+    detections = []
+    track_ids = columns.get("track_ids")
+    for i, (box, class_id, confidence) in enumerate(zip(
+            columns.get("boxes", []), columns.get("class_ids", []), columns.get("confidences", []))):
+        if confidence < threshold:
+            continue
+        detection = {
+            "class_id": class_id,
+            "label": labels[str(class_id)],
+            "confidence": confidence,
+            "bbox": box
+        }
+        if track_ids is not None:
+            detection["track_id"] = track_ids[i]
+        detections.append(detection)
+    return detections
+
+
+def _label_map(detection_lists):
+    return {
+        str(d["class_id"]): d["label"]
+        for detections in detection_lists for d in detections
+    }
+
+
+def image_record(detections, size, source, annotated, file_id, model, threshold):
+    """Record for an image: size is (width, height), source and annotated are (bucket, key)"""
+    return {
+        "format": RECORD_FORMAT,
+        "kind": "image",
+        "file_id": file_id,
+        "model": model,
+        "threshold": threshold,
+        "source": {"bucket": source[0], "key": source[1]},
+        "annotated": {"bucket": annotated[0], "key": annotated[1]},
+        "size": list(size),
+        "labels": _label_map([detections]),
+        "detections": encode_detections(detections),
+    }
+
+
+def video_record(frames, size, fps, source, annotated, file_id, model, threshold, tracks, inference_frames,
+                 min_track_hits):
+    """Record for a video, with frames holding one detection list per frame in order.
+
+    tracks are the confirmed tracks ingest counted (KeyframeDetector.tracks()).
+    """
+    return {
+        "format": RECORD_FORMAT,
+        "kind": "video",
+        "file_id": file_id,
+        "model": model,
+        "threshold": threshold,
+        "source": {"bucket": source[0], "key": source[1]},
+        "annotated": {"bucket": annotated[0], "key": annotated[1]},
+        "size": list(size),
+        "fps": fps,
+        "labels": _label_map(frames),
+        "frames": [encode_detections(detections) for detections in frames],
+        "track_hits": {str(t["track_id"]): t["hits"] for t in tracks},
+        "inference_frames": inference_frames,
+        "min_track_hits": min_track_hits,
+    }
+
+
+def confirmed_tracks(record, min_track_hits=None):
+    """Ids of the tracks with enough detector hits to count, None for records that predate track_hits"""
+    if "track_hits" not in record:
+        return None
+    min_track_hits = record["min_track_hits"] if min_track_hits is None else min_track_hits
+    min_hits = min(min_track_hits, max(1, record["inference_frames"]))
+    return {int(track_id) for track_id, hits in record["track_hits"].items() if hits >= min_hits}
+
+
+def tag_counts(record, threshold=None, min_track_hits=None):
+    """Per-species counts as stored in BirdTagsData: detections for images, confirmed tracks for videos.
+
+    Only the tracks ingest confirmed are stored with their hits, so like the
+    threshold, min_track_hits can only be raised.
+    """
+    threshold = record["threshold"] if threshold is None else threshold
+    labels = record["labels"]
+    if record["kind"] == "image":
+        found = [d["label"] for d in decode_detections(record["detections"], labels, threshold)]
+    else:
+        confirmed = confirmed_tracks(record, min_track_hits)
+        tracks = {}
+        for columns in record["frames"]:
+            for d in decode_detections(columns, labels, threshold):
+                if confirmed is None or d.get("track_id") in confirmed:
+                    tracks.setdefault(d.get("track_id"), d["label"])
+        found = list(tracks.values())
+
+    return [{"label": label, "count": count} for label, count in Counter(found).items()]
+
+
+def save_record(s3, bucket, key, record):
+    body = gzip.compress(json.dumps(record, separators=(",", ":")).encode("utf-8"))
+    s3.put_object(Bucket=bucket, Key=key, Body=body, ContentType="application/json", ContentEncoding="gzip")
+
+
+def load_record(s3, bucket, key):
+    obj = s3.get_object(Bucket=bucket, Key=key)
+    record = json.loads(gzip.decompress(obj["Body"].read()))
+    if record.get("format") != RECORD_FORMAT:
+        raise ValueError(f"Unsupported detection record format {record.get('format')} in {key}")
+    return record
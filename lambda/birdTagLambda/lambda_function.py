@@ -1,11 +1,20 @@
 import json
 import boto3
-from utils import run_inference, draw_detections, process_video
+from utils import run_inference_cascade, draw_detections, process_video, get_model, detection_cache, CONFIDENCE_THRESHOLD
+from utils import is_warmup_event, warm_up, CASCADE_ENABLED, MIN_TRACK_HITS
+from detection_cache import content_hash, model_tag, IMAGE_FULL, IMAGE_CASCADE
+from detection_records import image_record, video_record, record_key, save_record
+from annotation import ensure_annotated
+from metrics import invocation
 from PIL import Image
 import io
 import os
+import threading
+import time
 import uuid
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus
 import logging
 
 # Set up logging
@@ -13,97 +22,305 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 s3 = boto3.client('s3')
-dynamodb = boto3.resource('dynamodb')
 TABLE_NAME = "BirdTagsData"
+OUTPUT_BUCKET = "team99-uploaded-files"
+IMAGE_EXTENSIONS = [".jpg", ".jpeg", ".png"]
+VIDEO_EXTENSIONS = [".mp4", ".avi", ".mov", ".mkv"]
+RECORD_WORKERS = int(os.environ.get("RECORD_WORKERS", "4"))
+# With 0, annotated copies are only rendered, from the stored detections, when first requested
+EAGER_ANNOTATION = os.environ.get("EAGER_ANNOTATION", "1") == "1"
 
-def lambda_handler(event, context):
-    s3_event = event['Records'][0]['s3']
-    bucket = s3_event['bucket']['name']
-    key = s3_event['object']['key']
-    file_id = str(uuid.uuid4())
+# Inference already uses every core, so records only overlap their S3 and
+# DynamoDB I/O and take turns on the model
+inference_lock = threading.Lock()
+# boto3 clients are thread-safe but resources are not, each worker gets its own table
+_thread_state = threading.local()
 
-    _, ext = os.path.splitext(key.lower())
+def get_table():
+    if not hasattr(_thread_state, "table"):
+        _thread_state.table = boto3.session.Session().resource('dynamodb').Table(TABLE_NAME)
+    return _thread_state.table
+
+def s3_records(event):
+    """Yield (message_id, s3 record) for every object in an S3 event or an SQS batch of S3 events.
 
-    if ext in [".jpg", ".jpeg", ".png"]:
-        logger.info("Processing image file...")
+    message_id is the SQS message the object came in, None for direct S3
+    notifications, so failures can be reported back per message.
+    """
+    for record in event.get('Records', []):
+        if 's3' in record:
+            yield None, record['s3']
+        elif 'body' in record:
+            for inner in json.loads(record['body']).get('Records', []):
+                if 's3' in inner:
+                    yield record.get('messageId'), inner['s3']
 
-        thumbnail_key = key
-        logger.info(f"Thumbnail key: {thumbnail_key}")
+def process_image(bucket, key, file_id, timer):
+    thumbnail_key = key
+    logger.info(f"Thumbnail key: {thumbnail_key}")
 
-        filename = os.path.basename(thumbnail_key)
-        logger.info(f"Filename: {filename}")
+    filename = os.path.basename(thumbnail_key)
+    logger.info(f"Filename: {filename}")
 
-        original_key = "uploads/" + filename
-        logger.info(f"Original key: {original_key}")
-        
-        annotated_key = "annotated/images/" + filename
-        logger.info(f"Annotated key: {annotated_key}")
+    original_key = "uploads/" + filename
+    logger.info(f"Original key: {original_key}")
 
-        input_path = "/tmp/input.jpg"
-        annotated_path = "/tmp/annotated.jpg"
+    annotated_key = "annotated/images/" + filename
+    logger.info(f"Annotated key: {annotated_key}")
 
-        try:
-            # Download original image for inference
-            logger.info(f"Fetching original image from S3 at {original_key}")
+    try:
+        # Download original image for inference
+        logger.info(f"Fetching original image from S3 at {original_key}")
+        with timer.stage("download"):
             image_obj = s3.get_object(Bucket=bucket, Key=original_key)
             image_bytes = image_obj['Body'].read()
-            image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-            image.save(input_path)
-            logger.info(f"Original image fetched successfully from {original_key}")
-            
-        except Exception as e:
-            logger.info(f"Failed to fetch original image at {original_key}")
-            return {"statusCode": 404, "body": "Original image not found."}
+        timer.value("payload_bytes", len(image_bytes), "Bytes")
+        logger.info(f"Original image fetched successfully from {original_key}")
+
+    except Exception as e:
+        logger.info(f"Failed to fetch original image at {original_key}")
+        return None, {"statusCode": 404, "error": "Original image not found."}
+
+    digest = content_hash(image_bytes)
+
+    # Decode once and keep everything in memory from here on
+    with timer.stage("decode"):
+        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        del image_bytes
 
-        # Inference and annotation
-        detections = run_inference(input_path)
-        draw_detections(input_path, detections, annotated_path)
+    with timer.stage("model"):
+        tag = model_tag(get_model())
+    timer.set(model_version=tag)
 
-        with open(annotated_path, "rb") as f:
-            s3.upload_fileobj(f, "team99-uploaded-files", annotated_key)
+    # Full-pass results (possibly from the query Lambda) are as good as the cascade's
+    detections, cache_tier = detection_cache.get(digest, tag, IMAGE_FULL)
+    if cache_tier is None and CASCADE_ENABLED:
+        detections, cache_tier = detection_cache.get(digest, tag, IMAGE_CASCADE)
+    if cache_tier is not None:
+        cascade_stage = "cache"
+        logger.info(f"Reusing detections for {digest} from the {cache_tier} cache")
+    else:
+        start = time.perf_counter()
+        with inference_lock:
+            timer.add("inference_wait", (time.perf_counter() - start) * 1000)
+            with timer.stage("inference"):
+                detections, cascade_stage = run_inference_cascade(image)
+        kind = IMAGE_FULL if cascade_stage == "full" else IMAGE_CASCADE
+        detection_cache.put(digest, tag, kind, detections)
+    timer.set(cascade_stage=cascade_stage)
+    logger.info(f"Detection decided at the {cascade_stage} stage")
+    size = image.size
+
+    if EAGER_ANNOTATION:
+        with timer.stage("annotate"):
+            annotated_buffer = io.BytesIO()
+            # The decoded image is not needed after this, so annotate it in place
+            draw_detections(image, detections, annotated_buffer, copy=False)
+            annotated_buffer.seek(0)
+
+        with timer.stage("upload"):
+            s3.upload_fileobj(annotated_buffer, OUTPUT_BUCKET, annotated_key)
+
+    with timer.stage("record"):
+        record = image_record(detections, size, (bucket, original_key), (OUTPUT_BUCKET, annotated_key),
+                              file_id, tag, CONFIDENCE_THRESHOLD)
+        save_record(s3, OUTPUT_BUCKET, record_key(annotated_key), record)
+
+    item = {
+        'file_type': 'image',
+        'original_s3_url': f"s3://{bucket}/{original_key}",
+        'thumbnail_s3_url': f"s3://{bucket}/{thumbnail_key}",
+        'annotated_s3_url': f"s3://{OUTPUT_BUCKET}/{annotated_key}",
+        'annotation': 'eager' if EAGER_ANNOTATION else 'lazy',
+    }
+    return detections, {**item, "cascade_stage": cascade_stage}
 
-        output_key = annotated_key
-        original_url = f"s3://{bucket}/{original_key}"
-        thumbnail_url = f"s3://{bucket}/{thumbnail_key}"
+def process_video_record(bucket, key, file_id, ext, timer):
+    # Records run side by side, and a batch can repeat a key, so each one needs its own scratch files
+    scratch = uuid.uuid4().hex
+    input_path = f"/tmp/{scratch}-input{ext}"
+    annotated_path = f"/tmp/{scratch}-annotated{ext}" if EAGER_ANNOTATION else None
 
-    elif ext in [".mp4", ".avi", ".mov", ".mkv"]:
-        logger.info("Processing video file...")
-        input_path = "/tmp/input" + ext
-        annotated_path = "/tmp/annotated" + ext
+    frames = []
+    try:
+        with timer.stage("download"):
+            s3.download_file(bucket, key, input_path)
+        timer.value("payload_bytes", os.path.getsize(input_path), "Bytes")
 
-        s3.download_file(bucket, key, input_path)
-        detections = process_video(input_path, annotated_path)
+        start = time.perf_counter()
+        with inference_lock:
+            timer.add("inference_wait", (time.perf_counter() - start) * 1000)
+            with timer.stage("model"):
+                tag = model_tag(get_model())
+            timer.set(model_version=tag)
+            # Decoding, detection and encoding overlap inside process_video
+            with timer.stage("video"):
+                detections, video_stats = process_video(input_path, annotated_path, frame_detections=frames)
+        timer.value("frames", video_stats["frames"])
 
         output_key = "annotated/videos/" + os.path.basename(key)
-        with open(annotated_path, "rb") as f:
-            s3.upload_fileobj(f, "team99-uploaded-files", output_key)
+        if EAGER_ANNOTATION:
+            with timer.stage("upload"), open(annotated_path, "rb") as f:
+                s3.upload_fileobj(f, OUTPUT_BUCKET, output_key)
+    finally:
+        for path in (input_path, annotated_path):
+            if path and os.path.exists(path):
+                os.remove(path)
 
+    with timer.stage("record"):
+        record = video_record(frames, video_stats["frame_size"], video_stats["video_fps"], (bucket, key),
+                              (OUTPUT_BUCKET, output_key), file_id, tag, CONFIDENCE_THRESHOLD,
+                              detections, video_stats["inference_frames"], MIN_TRACK_HITS)
+        save_record(s3, OUTPUT_BUCKET, record_key(output_key), record)
+
+    item = {
+        'file_type': 'video',
+        'original_s3_url': f"s3://{bucket}/{key}",
+        'thumbnail_s3_url': None,
+        'annotated_s3_url': f"s3://{OUTPUT_BUCKET}/{output_key}",
+        'annotation': 'eager' if EAGER_ANNOTATION else 'lazy',
+    }
+    return detections, {**item, "video_stats": video_stats}
+
+def file_id_for(bucket, key):
+    """Stable id of an uploaded file, so a retried event overwrites its item instead of adding another"""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"s3://{bucket}/{key}"))
+
+def process_record(s3_record):
+    """Tag one uploaded file, returning its status as it appears in the handler's response"""
+    bucket = s3_record['bucket']['name']
+    key = unquote_plus(s3_record['object']['key'])
+    file_id = file_id_for(bucket, key)
+
+    _, ext = os.path.splitext(key.lower())
+
+    with invocation("birdTagLambda", key=key, file_type=ext.lstrip(".")) as timer:
+        result = tag_file(bucket, key, file_id, ext, timer)
+        timer.set(status_code=result["statusCode"])
+    return result
+
+def tag_file(bucket, key, file_id, ext, timer):
+    if ext in IMAGE_EXTENSIONS:
+        logger.info(f"Processing image file {key}...")
+        detections, outcome = process_image(bucket, key, file_id, timer)
+    elif ext in VIDEO_EXTENSIONS:
+        logger.info(f"Processing video file {key}...")
+        detections, outcome = process_video_record(bucket, key, file_id, ext, timer)
     else:
-        return {"statusCode": 400, "body": "Unsupported file type"}
+        return {"key": key, "statusCode": 400, "error": "Unsupported file type"}
+
+    if detections is None:
+        return {"key": key, **outcome}
 
     label_counts = Counter(d['label'] for d in detections)
     bird_summary = [{"label": label, "count": count} for label, count in label_counts.items()]
-    annotated_url = f"s3://{bucket}/{output_key}"
 
     logger.info("Inference complete...")
 
-    table = dynamodb.Table(TABLE_NAME)
-    table.put_item(Item={
-        'file_id': file_id,
-        'file_type': 'video' if ext in [".mp4", ".avi", ".mov", ".mkv"] else 'image',
-        'original_s3_url': original_url if ext in [".jpg", ".jpeg", ".png"] else f"s3://{bucket}/{key}",
-        'thumbnail_s3_url': thumbnail_url if ext in [".jpg", ".jpeg", ".png"] else None,
-        'annotated_s3_url': f"s3://{bucket}/{output_key}" if ext in [".mp4", ".avi", ".mov", ".mkv"] else annotated_url,
-        "detected_birds": bird_summary
-    })
+    extra = {name: outcome.pop(name) for name in ("cascade_stage", "video_stats") if name in outcome}
+    with timer.stage("dynamodb"):
+        get_table().put_item(Item={
+            'file_id': file_id,
+            **outcome,
+            "detected_birds": bird_summary
+        })
 
-    logger.info("Done writing to DynamoDB, about to return...")
+    logger.info(f"Done writing {key} to DynamoDB")
 
     return {
+        "key": key,
         "statusCode": 200,
+        "message": "Inference complete",
+        "detected_birds": bird_summary,
+        "annotated_output": outcome['annotated_s3_url'],
+        **extra
+    }
+
+def safe_process_record(s3_record):
+    try:
+        return process_record(s3_record)
+    except Exception as e:
+        key = s3_record.get('object', {}).get('key')
+        logger.exception(f"Failed to process {key}")
+        return {"key": key, "statusCode": 500, "error": str(e)}
+
+def is_retryable(result):
+    # A missing original may just not have landed yet, unsupported files never will work
+    return result["statusCode"] == 404 or result["statusCode"] >= 500
+
+def render_on_request(event):
+    """Make sure a lazily annotated file exists, rendering it from its detection record, and presign it"""
+    uri = event.get('annotated_s3_url', '')
+    if not uri.startswith("s3://"):
+        return {"statusCode": 400, "body": json.dumps({"error": "Missing 'annotated_s3_url'"})}
+
+    bucket, key = uri[len("s3://"):].split("/", 1)
+    with invocation("birdTagLambda.render", key=key) as timer:
+        with timer.stage("render"):
+            rendered = ensure_annotated(s3, bucket, key)
+        timer.set(rendered=rendered)
+    if rendered:
+        logger.info(f"Rendered {key} on first request")
+
+    url = s3.generate_presigned_url("get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=300)
+    return {"statusCode": 200, "body": json.dumps({"annotated_url": url, "rendered": rendered})}
+
+def handle_warmup():
+    """Prime the model for a scheduled ping or provisioned concurrency, reporting how long each step took"""
+    with invocation("birdTagLambda.warmup") as timer:
+        model = warm_up(timer)
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "warmup": True,
+            "cold_start": timer.cold_start,
+            "model_version": model.version,
+            "model_variant": model.variant,
+            "timings_ms": {stage: round(ms, 1) for stage, ms in timer.stages.items()}
+        })
+    }
+
+def lambda_handler(event, context):
+    if is_warmup_event(event):
+        return handle_warmup()
+    if event.get('action') == 'render':
+        return render_on_request(event)
+
+    records = list(s3_records(event))
+    workers = max(1, min(RECORD_WORKERS, len(records)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(safe_process_record, [s3_record for _, s3_record in records]))
+
+    failed = [result for result in results if result["statusCode"] != 200]
+    logger.info(f"Processed {len(results)} records, {len(failed)} failed")
+
+    if len(results) == 1:
+        status = results[0]["statusCode"]
+    else:
+        status = 207 if failed else 200
+
+    response = {
+        "statusCode": status,
         "body": json.dumps({
-            "message": "Inference complete",
-            "detected_birds": bird_summary,
-            "annotated_output": annotated_url
+            "processed": len(results),
+            "failed": len(failed),
+            "results": results
         })
     }
+
+    # SQS batches with ReportBatchItemFailures only redeliver these messages
+    failed_messages = {
+        message_id for (message_id, _), result in zip(records, results)
+        if message_id is not None and is_retryable(result)
+    }
+    if any(message_id is not None for message_id, _ in records):
+        response["batchItemFailures"] = [{"itemIdentifier": message_id} for message_id in sorted(failed_messages)]
+
+    # Direct S3 notifications are invoked asynchronously, and only a raised
+    # error makes Lambda retry them; per-record isolation is for SQS batches
+    retry = [result["key"] for (message_id, _), result in zip(records, results)
+             if message_id is None and is_retryable(result)]
+    if retry:
+        raise RuntimeError(f"Retryable failures for {retry}: {response['body']}")
+
+    return response
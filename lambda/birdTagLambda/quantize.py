@@ -0,0 +1,224 @@
+"""Build and evaluate the INT8 variant of the detection model.
+
+Run from this directory (needs the onnx package on top of the Lambda's
+requirements):
+
+    python quantize.py build --calibration path/to/images [--version v3] [--upload]
+    python quantize.py report --images path/to/images [--version v3]
+
+build statically quantizes the FP32 model of a version using our own images
+for calibration and writes model.int8.onnx next to it in the model cache;
+--upload publishes it to the version's S3 prefix, where the model store
+picks it up when MODEL_VARIANT=int8. report runs both variants over the same
+images and prints latency, memory and how well the INT8 detections agree
+with FP32.
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import resource
+import time
+
+import numpy as np
+
+import model_store
+import utils
+
+
+def list_images(folder):
+    paths = sorted(
+        path for path in glob.glob(os.path.join(folder, "*"))
+        if path.lower().endswith((".jpg", ".jpeg", ".png"))
+    )
+    if not paths:
+        raise SystemExit(f"No images found in {folder}")
+    return paths
+
+
+def make_calibration_reader(image_paths, input_name):
+    from onnxruntime.quantization import CalibrationDataReader
+
+    class ImageCalibrationReader(CalibrationDataReader):
+        """Feeds our own images through the regular preprocessing for calibration"""
+
+        def __init__(self):
+            self._paths = iter(image_paths)
+
+        def get_next(self):
+            path = next(self._paths, None)
+            if path is None:
+                return None
+            tensor, _ = utils.preprocess(path)
+            return {input_name: tensor.copy()}
+
+    return ImageCalibrationReader()
+
+
+def build(args):
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    store = utils.model_store
+    version = args.version or store.current_version()
+    fp32_path = store.fetch(version, model_store.MODEL_VARIANTS["fp32"])
+    int8_path = os.path.join(store.cache_dir, version, model_store.MODEL_VARIANTS["int8"])
+    prepared_path = int8_path + ".prep"
+
+    image_paths = list_images(args.calibration)[:args.max_images]
+    input_name = model_store.create_session(fp32_path, "baseline").get_inputs()[0].name
+    print(f"Quantizing version {version} with {len(image_paths)} calibration images")
+
+    start = time.perf_counter()
+    quant_pre_process(fp32_path, prepared_path)
+    quantize_static(
+        prepared_path,
+        int8_path,
+        make_calibration_reader(image_paths, input_name),
+        quant_format=QuantFormat.QDQ,
+        per_channel=True,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+    )
+    os.remove(prepared_path)
+
+    digest = model_store.file_sha256(int8_path)
+    with open(int8_path + ".sha256", "w") as f:
+        f.write(digest)
+    print(f"Wrote {int8_path} ({os.path.getsize(int8_path) / 1e6:.1f} MB, "
+          f"FP32 {os.path.getsize(fp32_path) / 1e6:.1f} MB) in {time.perf_counter() - start:.0f}s")
+
+    if args.upload:
+        key = f"{store.prefix}/models/{version}/{model_store.MODEL_VARIANTS['int8']}"
+        store.s3.upload_file(int8_path, store.bucket, key)
+        store.s3.put_object(Bucket=store.bucket, Key=key + ".sha256", Body=digest.encode("utf-8"))
+        print(f"Uploaded to s3://{store.bucket}/{key}")
+
+
+def _peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run_variant(model_path, labels, image_paths, profile):
+    """Run one variant in a fresh process so its memory use is measured on its own.
+
+    Memory is reported as two peak-RSS increases: creating the session
+    (weights and graph), and running inference on top of that (activations
+    and arena growth). Images are preprocessed one at a time into
+    preprocess's single reused buffer, so inputs add the same small
+    constant to both variants.
+    """
+    rss_start = _peak_rss_mb()
+    session = model_store.create_session(model_path, profile)
+    input_name = session.get_inputs()[0].name
+    rss_session = _peak_rss_mb()
+
+    session.run(None, {input_name: utils.preprocess(image_paths[0])[0]})
+
+    timings, detections = [], []
+    for path in image_paths:
+        tensor, geometry = utils.preprocess(path)
+        start = time.perf_counter()
+        output = session.run(None, {input_name: tensor})
+        timings.append((time.perf_counter() - start) * 1000)
+        detections.append(utils.postprocess(output, geometry, labels))
+
+    memory = {"session_mb": rss_session - rss_start, "inference_mb": _peak_rss_mb() - rss_session}
+    return timings, detections, memory
+
+
+def agreement(reference, candidate, iou_thresh=0.5):
+    """Match candidate detections to the reference ones by class and IoU"""
+    matched, confidence_deltas, same_labels = 0, [], 0
+    for ref, cand in zip(reference, candidate):
+        ref_labels = sorted(d["label"] for d in ref)
+        same_labels += ref_labels == sorted(d["label"] for d in cand)
+
+        used = set()
+        for r in ref:
+            best, best_iou = None, iou_thresh
+            for j, c in enumerate(cand):
+                if j in used or c["class_id"] != r["class_id"]:
+                    continue
+                iou = utils.box_iou([r["bbox"]], [c["bbox"]])[0, 0]
+                if iou >= best_iou:
+                    best, best_iou = j, iou
+            if best is not None:
+                used.add(best)
+                matched += 1
+                confidence_deltas.append(abs(cand[best]["confidence"] - r["confidence"]))
+
+    total_ref = sum(len(d) for d in reference)
+    total_cand = sum(len(d) for d in candidate)
+    return {
+        "recall_vs_fp32": matched / total_ref if total_ref else 1.0,
+        "precision_vs_fp32": matched / total_cand if total_cand else 1.0,
+        "same_labels": same_labels / len(reference) if reference else 1.0,
+        "mean_confidence_delta": float(np.mean(confidence_deltas)) if confidence_deltas else 0.0,
+    }
+
+
+def report(args):
+    store = utils.model_store
+    version = args.version or store.current_version()
+    labels_path = store.fetch(version, "labels.json")
+    with open(labels_path) as f:
+        labels = json.load(f)
+    image_paths = list_images(args.images)[:args.max_images]
+
+    results = {}
+    ctx = multiprocessing.get_context("spawn")
+    for variant, name in model_store.MODEL_VARIANTS.items():
+        model_path = store.fetch(version, name)
+        with ctx.Pool(1) as pool:
+            results[variant] = pool.apply(_run_variant, (model_path, labels, image_paths, args.profile))
+
+    summary = {"version": version, "images": len(image_paths), "profile": args.profile, "variants": {}}
+    print(f"version {version}, {len(image_paths)} images, profile {args.profile}")
+    print(f"{'variant':>8} {'p50 ms':>7} {'p90 ms':>7} {'session MB':>11} {'inference MB':>13} {'detections':>10}")
+    for variant, (timings, detections, memory) in results.items():
+        summary["variants"][variant] = {
+            "p50_ms": float(np.percentile(timings, 50)),
+            "p90_ms": float(np.percentile(timings, 90)),
+            **memory,
+            "detections": sum(len(d) for d in detections),
+        }
+        print(f"{variant:>8} {np.percentile(timings, 50):>7.1f} {np.percentile(timings, 90):>7.1f} "
+              f"{memory['session_mb']:>11.0f} {memory['inference_mb']:>13.0f} "
+              f"{summary['variants'][variant]['detections']:>10}")
+
+    summary["agreement"] = agreement(results["fp32"][1], results["int8"][1])
+    for key, value in summary["agreement"].items():
+        print(f"{key:>22}: {value:.3f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Quantize a model version to INT8")
+    build_parser.add_argument("--calibration", required=True, help="Folder of calibration images")
+    build_parser.add_argument("--version", help="Model version, defaults to the published one")
+    build_parser.add_argument("--max-images", type=int, default=200)
+    build_parser.add_argument("--upload", action="store_true", help="Publish model.int8.onnx to S3")
+    build_parser.set_defaults(func=build)
+
+    report_parser = subparsers.add_parser("report", help="Compare INT8 against FP32")
+    report_parser.add_argument("--images", required=True, help="Folder of evaluation images")
+    report_parser.add_argument("--version", help="Model version, defaults to the published one")
+    report_parser.add_argument("--max-images", type=int, default=200)
+    report_parser.add_argument("--profile", default=model_store.ORT_PROFILE)
+    report_parser.add_argument("--output", help="Also write the report as JSON")
+    report_parser.set_defaults(func=report)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
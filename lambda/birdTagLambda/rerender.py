@@ -0,0 +1,81 @@
+"""Regenerate annotated outputs and tag counts from stored detection records.
+
+Run from this directory with credentials for the uploads bucket:
+
+    python rerender.py [--prefix annotated/images/] [--threshold 0.6] [--min-track-hits 3] [--update-tags] [--dry-run]
+
+Every detection record (see detection_records.py) under the prefix is
+redrawn onto its source file and uploaded over the annotated output, without
+running the model. --threshold drops detections below a new confidence,
+which can only be higher than the one used at ingest. --min-track-hits
+likewise only counts video tracks the detector confirmed more often.
+--update-tags also rewrites the detected_birds counts in BirdTagsData, which
+is needed when either changes.
+"""
+import argparse
+import time
+
+import boto3
+
+from annotation import render_record
+from detection_records import RECORD_SUFFIX, load_record, tag_counts
+from lambda_function import OUTPUT_BUCKET, TABLE_NAME
+
+
+def list_records(s3, bucket, prefix):
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith(RECORD_SUFFIX):
+                yield obj["Key"]
+
+
+def rerender(args):
+    s3 = boto3.client("s3")
+    table = boto3.resource("dynamodb").Table(TABLE_NAME)
+
+    count, seconds = 0, 0.0
+    for key in list_records(s3, args.bucket, args.prefix):
+        record = load_record(s3, args.bucket, key)
+        threshold = record["threshold"] if args.threshold is None else args.threshold
+        if threshold < record["threshold"]:
+            print(f"{key}: detections below {record['threshold']} were not stored, using that instead of {threshold}")
+            threshold = record["threshold"]
+
+        annotated = record["annotated"]
+        counts = tag_counts(record, threshold, args.min_track_hits)
+        start = time.perf_counter()
+        render_record(s3, record, threshold, upload=not args.dry_run)
+        elapsed = time.perf_counter() - start
+
+        print(f"{annotated['key']}: {elapsed * 1000:.0f} ms, tags {counts}")
+        if args.update_tags and not args.dry_run:
+            table.update_item(
+                Key={"file_id": record["file_id"]},
+                UpdateExpression="SET detected_birds = :birds",
+                ExpressionAttributeValues={":birds": counts},
+            )
+
+        count += 1
+        seconds += elapsed
+
+    print(f"Re-rendered {count} files in {seconds:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bucket", default=OUTPUT_BUCKET)
+    parser.add_argument("--prefix", default="annotated/")
+    parser.add_argument("--threshold", type=float, help="Confidence threshold, defaults to the one used at ingest")
+    parser.add_argument("--min-track-hits", type=int,
+                        help="Detector hits a video track needs to count, defaults to the one used at ingest")
+    parser.add_argument("--update-tags", action="store_true", help="Rewrite detected_birds in BirdTagsData")
+    parser.add_argument("--dry-run", action="store_true", help="Render and report without uploading")
+    parser.set_defaults(func=rerender)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
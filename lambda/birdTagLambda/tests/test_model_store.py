@@ -0,0 +1,138 @@
+"""ModelStore against the local S3 stand-in from benchmark.py.
+
+Run from lambda/birdTagLambda with: python -m pytest tests
+"""
+import hashlib
+import json
+import os
+
+import pytest
+
+import model_store
+from benchmark import LocalS3, make_stub_model
+
+BUCKET, PREFIX = model_store.MODEL_S3_BUCKET, model_store.MODEL_S3_PREFIX
+LABELS = ["sparrow", "crow"]
+
+
+class RecordingS3(LocalS3):
+    """LocalS3 that remembers which keys were read"""
+
+    def __init__(self, root):
+        super().__init__(root)
+        self.reads = []
+
+    def get_object(self, Bucket, Key):
+        self.reads.append(Key)
+        return super().get_object(Bucket, Key)
+
+    def download_file(self, Bucket, Key, Filename):
+        self.reads.append(Key)
+        super().download_file(Bucket, Key, Filename)
+
+
+@pytest.fixture
+def s3(tmp_path):
+    return RecordingS3(str(tmp_path / "s3"))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Controllable monotonic clock for the version check TTL"""
+    now = [1000.0]
+    monkeypatch.setattr(model_store.time, "monotonic", lambda: now[0])
+    return now
+
+
+def publish(s3, tmp_path, version, seed=0):
+    """Upload a stub model version with its published checksum"""
+    model_path = str(tmp_path / f"{version}.onnx")
+    make_stub_model(model_path, len(LABELS), seed=seed)
+    key = f"{PREFIX}/models/{version}/model.onnx"
+    s3.upload_file(model_path, BUCKET, key)
+    s3.put_object(Bucket=BUCKET, Key=key + ".sha256", Body=model_store.file_sha256(model_path))
+    s3.put_object(Bucket=BUCKET, Key=f"{PREFIX}/models/{version}/labels.json", Body=json.dumps(LABELS))
+
+
+def set_current(s3, version):
+    s3.put_object(Bucket=BUCKET, Key=f"{PREFIX}/current_version.txt", Body=version)
+
+
+def make_store(s3, tmp_path, check_seconds=60):
+    return model_store.ModelStore(cache_dir=str(tmp_path / "cache"), check_seconds=check_seconds,
+                                  profile="baseline", s3_client=s3)
+
+
+def test_bad_checksum_raises_and_caches_nothing(s3, tmp_path):
+    key = f"{PREFIX}/models/v1/model.onnx"
+    s3.put_object(Bucket=BUCKET, Key=key, Body=b"truncated model")
+    s3.put_object(Bucket=BUCKET, Key=key + ".sha256", Body=hashlib.sha256(b"full model").hexdigest())
+    store = make_store(s3, tmp_path)
+
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        store.fetch("v1", "model.onnx")
+
+    assert os.listdir(tmp_path / "cache" / "v1") == []
+
+
+def test_corrupt_cached_copy_is_downloaded_again(s3, tmp_path):
+    pytest.importorskip("onnx")
+    publish(s3, tmp_path, "v1")
+    store = make_store(s3, tmp_path)
+    path = store.fetch("v1", "model.onnx")
+    with open(path, "r+b") as f:
+        f.truncate(16)
+
+    s3.reads.clear()
+    assert store.fetch("v1", "model.onnx") == path
+    assert f"{PREFIX}/models/v1/model.onnx" in s3.reads
+    assert model_store.file_sha256(path) == s3.get_object(
+        Bucket=BUCKET, Key=f"{PREFIX}/models/v1/model.onnx.sha256")["Body"].read().decode()
+
+
+def test_version_is_only_rechecked_after_ttl(s3, tmp_path, clock):
+    pytest.importorskip("onnx")
+    publish(s3, tmp_path, "v1")
+    set_current(s3, "v1")
+    store = make_store(s3, tmp_path, check_seconds=60)
+    first = store.get()
+
+    s3.reads.clear()
+    clock[0] += 59
+    assert store.get() is first
+    assert s3.reads == []
+
+    clock[0] += 2
+    assert store.get() is first
+    assert s3.reads == [f"{PREFIX}/current_version.txt"]
+
+
+def test_version_change_swaps_session(s3, tmp_path, clock):
+    pytest.importorskip("onnx")
+    publish(s3, tmp_path, "v1", seed=1)
+    set_current(s3, "v1")
+    store = make_store(s3, tmp_path, check_seconds=60)
+    first = store.get()
+
+    publish(s3, tmp_path, "v2", seed=2)
+    set_current(s3, "v2")
+    assert store.get() is first
+
+    clock[0] += 61
+    second = store.get()
+    assert second.version == "v2"
+    assert second.session is not first.session
+    assert second.labels == LABELS
+    assert os.listdir(tmp_path / "cache") == ["v2"]
+
+
+def test_failed_refresh_keeps_current_model(s3, tmp_path, clock):
+    pytest.importorskip("onnx")
+    publish(s3, tmp_path, "v1")
+    set_current(s3, "v1")
+    store = make_store(s3, tmp_path, check_seconds=60)
+    first = store.get()
+
+    set_current(s3, "v2")
+    clock[0] += 61
+    assert store.get() is first
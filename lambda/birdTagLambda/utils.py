@@ -1,120 +1,168 @@
-import onnxruntime as ort
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
-import json
+import io
+import itertools
 import os
+from collections import namedtuple
 import cv2
-import boto3
 import logging
+import queue
+import threading
+import time
+
+from detection_cache import DetectionCache
+from model_store import ModelStore
 
 # Set up logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# S3 configuration
-MODEL_S3_BUCKET = "team99-bird-detection-models"
-VERSION_FILE_KEY = "birdTagging/current_version.txt"
-
-LOCAL_MODEL_PATH = "/tmp/model.onnx"
-LOCAL_LABELS_PATH = "/tmp/labels.json"
 INPUT_SIZE = 640
+LETTERBOX_FILL = 114 / 255.0
 CONFIDENCE_THRESHOLD = 0.5
 IOU_THRESHOLD = 0.5
-
-s3 = boto3.client("s3")
-
-# Download the version string
-version_obj = s3.get_object(Bucket=MODEL_S3_BUCKET, Key=VERSION_FILE_KEY)
-version_str = version_obj["Body"].read().decode("utf-8").strip()
-logger.info(f"Using model version: {version_str}")
-
-# Construct model paths
-model_key = f"birdTagging/models/{version_str}/model.onnx"
-labels_key = f"birdTagging/models/{version_str}/labels.json"
-
-# Download if not already in /tmp
-if not os.path.exists(LOCAL_MODEL_PATH):
-    logger.info(f"Downloading model from S3: {model_key}")
-    s3.download_file(MODEL_S3_BUCKET, model_key, LOCAL_MODEL_PATH)
-if not os.path.exists(LOCAL_LABELS_PATH):
-    logger.info(f"Downloading labels from S3: {labels_key}")
-    s3.download_file(MODEL_S3_BUCKET, labels_key, LOCAL_LABELS_PATH)
-
-# Load ONNX session and labels
-session_options = ort.SessionOptions()
-session_options.enable_mem_pattern = False
-session_options.enable_cpu_mem_arena = True
-session_options.log_severity_level = 3
-session_options.log_verbosity_level = 0
-
-session = ort.InferenceSession(
-    LOCAL_MODEL_PATH,
-    sess_options=session_options,
-    providers=["CPUExecutionProvider"]
-)
-
-logger.info("ONNX model loaded successfully.")
-
-with open(LOCAL_LABELS_PATH, "r") as f:
-    class_labels = json.load(f)
-
-logger.info(f"Loaded class labels.")
-
-def preprocess(image_path):
-    image = Image.open(image_path).convert("RGB")
-    orig_w, orig_h = image.size
-    image_resized = image.resize((INPUT_SIZE, INPUT_SIZE))
-    img = np.array(image_resized).astype(np.float32) / 255.0
-    img = np.transpose(img, (2, 0, 1))
-    img = np.expand_dims(img, axis=0)
-    return img, (orig_w, orig_h)
-
-def postprocess(output, orig_size):
-    preds = np.transpose(output[0], (0, 2, 1))[0]
-    orig_w, orig_h = orig_size
-    results = []
-
-    for det in preds:
-        scores = det[4:]
-        class_id = int(np.argmax(scores))
-        confidence = scores[class_id]
-
-        if confidence > CONFIDENCE_THRESHOLD:
-            if class_id >= len(class_labels):
-                continue
-            xc, yc, w, h = det[:4]
-            x1, y1 = xc - w / 2, yc - h / 2
-            x2, y2 = xc + w / 2, yc + h / 2
-
-            x1 *= orig_w / INPUT_SIZE
-            y1 *= orig_h / INPUT_SIZE
-            x2 *= orig_w / INPUT_SIZE
-            y2 *= orig_h / INPUT_SIZE
-
-            results.append({
-                "class_id": class_id,
-                "label": class_labels[class_id],
-                "confidence": float(confidence),
-                "bbox": [x1, y1, x2, y2]
-            })
-
-    return results
-
-def non_max_suppression(detections, iou_thresh=IOU_THRESHOLD):
-    boxes = np.array([d["bbox"] for d in detections])
-    scores = np.array([d["confidence"] for d in detections])
-    indices = []
-
+BATCH_SIZE = 8
+TILING_MIN_PIXELS = int(os.environ.get("TILING_MIN_PIXELS", "12000000"))
+TILE_SIZE = int(os.environ.get("TILE_SIZE", "1280"))
+TILE_OVERLAP = 0.2
+TILE_CONTAIN_THRESHOLD = 0.8
+# Opt-in: an empty coarse pass skips the full pass, which can miss small or
+# distant birds. Measure with `benchmark.py cascade` on real uploads first
+CASCADE_ENABLED = os.environ.get("CASCADE", "0") == "1"
+CASCADE_SIZE = int(os.environ.get("CASCADE_SIZE", "320"))
+CASCADE_THRESHOLD = 0.2
+CASCADE_REGION_MARGIN = 0.5
+VIDEO_BATCH_SIZE = 4
+VIDEO_QUEUE_SIZE = 16
+KEYFRAME_INTERVAL = int(os.environ.get("KEYFRAME_INTERVAL", "1"))
+TRACK_IOU_THRESHOLD = 0.3
+TRACK_MAX_MISSES = 2
+MIN_TRACK_HITS = int(os.environ.get("MIN_TRACK_HITS", "2"))
+MOTION_THRESHOLD = float(os.environ.get("MOTION_THRESHOLD", "0.005"))
+MOTION_PIXEL_DELTA = 12
+MOTION_SIZE = (96, 54)
+WARMUP_SIZE = (1280, 720)
+
+# The model is fetched and loaded on first inference, not at import
+model_store = ModelStore()
+detection_cache = DetectionCache()
+
+def get_model():
+    """Current (session, labels, version, variant), refreshed when a new model version is published"""
+    return model_store.get()
+
+def load_image(image):
+    """Return an RGB PIL image from a path, raw bytes, file-like object, PIL image or RGB array"""
+    if isinstance(image, Image.Image):
+        return image if image.mode == "RGB" else image.convert("RGB")
+    if isinstance(image, np.ndarray):
+        return Image.fromarray(image)
+    if isinstance(image, (bytes, bytearray)):
+        image = io.BytesIO(image)
+    return Image.open(image).convert("RGB")
+
+# Where an image landed inside the model input: scaled by `scale`, then
+# offset by the padding on the left/top
+Letterbox = namedtuple("Letterbox", ["orig_w", "orig_h", "scale", "pad_x", "pad_y", "new_w", "new_h"])
+
+_buffers = threading.local()
+
+def input_buffer(batch_size, size=INPUT_SIZE):
+    """Reusable (batch_size, 3, size, size) float32 input tensor for the calling thread"""
+    if not hasattr(_buffers, "by_size"):
+        _buffers.by_size = {}
+    buffer = _buffers.by_size.get(size)
+    if buffer is None or len(buffer) < batch_size:
+        buffer = np.empty((batch_size, 3, size, size), dtype=np.float32)
+        _buffers.by_size[size] = buffer
+    return buffer[:batch_size]
+
+def letterbox_geometry(orig_w, orig_h, size=INPUT_SIZE):
+    scale = min(size / orig_w, size / orig_h)
+    new_w, new_h = max(1, round(orig_w * scale)), max(1, round(orig_h * scale))
+    return Letterbox(orig_w, orig_h, scale, (size - new_w) // 2, (size - new_h) // 2, new_w, new_h)
+
+def _write_letterbox(chw, geometry, out, size):
+    if out is None:
+        out = input_buffer(1, size)[0]
+    out.fill(LETTERBOX_FILL)
+    region = out[:, geometry.pad_y:geometry.pad_y + geometry.new_h, geometry.pad_x:geometry.pad_x + geometry.new_w]
+    region[...] = chw
+    region *= 1 / 255.0
+    return out[np.newaxis]
+
+def preprocess(image, out=None, size=INPUT_SIZE):
+    """Letterbox an image into a (1, 3, size, size) tensor, keeping its aspect ratio.
+
+    The tensor is written into out (one batch slot of a larger buffer) or into
+    this thread's reusable buffer, so it is only valid until the next call.
+    """
+    image = load_image(image)
+    geometry = letterbox_geometry(*image.size, size=size)
+    resized = np.asarray(image.resize((geometry.new_w, geometry.new_h), Image.BILINEAR))
+    return _write_letterbox(resized.transpose(2, 0, 1), geometry, out, size), geometry
+
+def preprocess_frame(frame, out=None):
+    """Letterbox a BGR video frame straight from OpenCV, without going through PIL"""
+    orig_h, orig_w = frame.shape[:2]
+    geometry = letterbox_geometry(orig_w, orig_h)
+    resized = cv2.resize(frame, (geometry.new_w, geometry.new_h), interpolation=cv2.INTER_LINEAR)
+    return _write_letterbox(resized[:, :, ::-1].transpose(2, 0, 1), geometry, out, INPUT_SIZE), geometry
+
+def decode_output(output, geometry, num_labels, conf_thresh=CONFIDENCE_THRESHOLD):
+    """Decode raw YOLO output into box, score and class arrays in one pass.
+
+    geometry is the Letterbox returned by preprocessing, or a plain
+    (width, height) for an image stretched to the input size.
+    """
+    preds = output[0][0].T
+
+    scores = preds[:, 4:]
+    class_ids = scores.argmax(axis=1)
+    confidences = scores[np.arange(len(scores)), class_ids]
+
+    mask = (confidences > conf_thresh) & (class_ids < num_labels)
+    xywh = preds[mask, :4].astype(np.float64)
+    confidences = confidences[mask].astype(np.float64)
+    class_ids = class_ids[mask]
+
+    boxes = np.empty_like(xywh)
+    boxes[:, 0] = xywh[:, 0] - xywh[:, 2] / 2
+    boxes[:, 1] = xywh[:, 1] - xywh[:, 3] / 2
+    boxes[:, 2] = xywh[:, 0] + xywh[:, 2] / 2
+    boxes[:, 3] = xywh[:, 1] + xywh[:, 3] / 2
+    if isinstance(geometry, Letterbox):
+        boxes -= [geometry.pad_x, geometry.pad_y, geometry.pad_x, geometry.pad_y]
+        boxes /= geometry.scale
+    else:
+        orig_w, orig_h = geometry
+        boxes *= np.array([orig_w, orig_h, orig_w, orig_h]) / INPUT_SIZE
+
+    return boxes, confidences, class_ids
+
+def nms_indices(boxes, scores, class_ids=None, iou_thresh=IOU_THRESHOLD):
+    """Greedy NMS over arrays, returning indices of the kept boxes.
+
+    When class_ids is given, boxes of different classes never suppress
+    each other.
+    """
     if len(boxes) == 0:
-        return []
+        return np.empty(0, dtype=np.int64)
+
+    if class_ids is not None:
+        # Shift each class into its own coordinate range so that boxes of
+        # different classes cannot overlap
+        span = boxes.max() - boxes.min() + 1
+        boxes = boxes + (class_ids * span)[:, None]
 
     x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
     areas = (x2 - x1) * (y2 - y1)
     order = scores.argsort()[::-1]
+    keep = []
 
     while order.size > 0:
         i = order[0]
-        indices.append(i)
+        keep.append(i)
 
         xx1 = np.maximum(x1[i], x1[order[1:]])
         yy1 = np.maximum(y1[i], y1[order[1:]])
@@ -126,21 +174,220 @@ def non_max_suppression(detections, iou_thresh=IOU_THRESHOLD):
         inter_area = inter_w * inter_h
         iou = inter_area / (areas[i] + areas[order[1:]] - inter_area)
 
-        keep = np.where(iou <= iou_thresh)[0]
-        order = order[keep + 1]
+        order = order[np.where(iou <= iou_thresh)[0] + 1]
+
+    return np.array(keep, dtype=np.int64)
+
+def build_detections(boxes, scores, class_ids, labels):
+    return [
+        {
+            "class_id": int(class_id),
+            "label": labels[class_id],
+            "confidence": float(score),
+            "bbox": box
+        }
+        for box, score, class_id in zip(boxes.tolist(), scores.tolist(), class_ids.tolist())
+    ]
+
+def postprocess(output, geometry, labels, class_aware=True):
+    boxes, scores, class_ids = decode_output(output, geometry, len(labels))
+    keep = nms_indices(boxes, scores, class_ids if class_aware else None)
+    return build_detections(boxes[keep], scores[keep], class_ids[keep], labels)
+
+def non_max_suppression(detections, iou_thresh=IOU_THRESHOLD):
+    if not detections:
+        return []
+    boxes = np.array([d["bbox"] for d in detections], dtype=np.float64)
+    scores = np.array([d["confidence"] for d in detections])
+    keep = nms_indices(boxes, scores, iou_thresh=iou_thresh)
+    return [detections[i] for i in keep]
+
+def run_inference(image, tiled=None):
+    """Detect birds in one image.
+
+    Images of TILING_MIN_PIXELS or more go through run_inference_tiled unless
+    tiled is given explicitly.
+    """
+    image = load_image(image)
+    if tiled is None:
+        tiled = image.size[0] * image.size[1] >= TILING_MIN_PIXELS
+    if tiled:
+        return run_inference_tiled(image)
+
+    input_tensor, geometry = preprocess(image)
+    model = get_model()
+    input_name = model.session.get_inputs()[0].name
+    output = model.session.run(None, {input_name: input_tensor})
+
+    return postprocess(output, geometry, model.labels)
+
+def run_inference_frame(frame):
+    input_tensor, geometry = preprocess_frame(frame)
+    model = get_model()
+    input_name = model.session.get_inputs()[0].name
+    output = model.session.run(None, {input_name: input_tensor})
+
+    return postprocess(output, geometry, model.labels)
+
+def model_batch_size(session=None):
+    """Batch dimension baked into the exported model, or None if dynamic"""
+    session = session or get_model().session
+    dim = session.get_inputs()[0].shape[0]
+    return dim if isinstance(dim, int) and dim > 0 else None
+
+def run_inference_batch(images, batch_size=BATCH_SIZE, preprocess_fn=preprocess):
+    """Run detection on several images, stacking them into shared session.run calls.
+
+    Returns one detection list per input image, in input order. Images are
+    preprocessed straight into the slots of a reusable batch buffer. Models
+    exported with a fixed batch dimension are fed chunks of exactly that size,
+    padding the last chunk with blank images. Pass
+    preprocess_fn=preprocess_frame for OpenCV frames.
+    """
+    model = get_model()
+    fixed_batch = model_batch_size(model.session)
+    if fixed_batch:
+        batch_size = fixed_batch
+
+    input_name = model.session.get_inputs()[0].name
+    results = []
+
+    for start in range(0, len(images), batch_size):
+        chunk = images[start:start + batch_size]
+        input_tensor = input_buffer(fixed_batch or len(chunk))
+        geometries = [preprocess_fn(image, out=input_tensor[i])[1] for i, image in enumerate(chunk)]
+        input_tensor[len(chunk):] = 0
 
-    return [detections[i] for i in indices]
+        output = model.session.run(None, {input_name: input_tensor})
+        for i, geometry in enumerate(geometries):
+            results.append(postprocess([output[0][i:i + 1]], geometry, model.labels))
 
-def run_inference(image_path):
-    input_tensor, orig_size = preprocess(image_path)
-    input_name = session.get_inputs()[0].name
-    output = session.run(None, {input_name: input_tensor})
+    return results
 
-    raw = postprocess(output, orig_size)
-    return non_max_suppression(raw)
+def _tile_starts(length, tile_size, stride):
+    if length <= tile_size:
+        return [0]
+    return list(range(0, length - tile_size, stride)) + [length - tile_size]
+
+def _tiles(image, tile_size, overlap, regions=None):
+    """Yield (x, y, crop) for a whole-image view and then overlapping tiles, cropped lazily.
+
+    With regions (x1, y1, x2, y2 boxes), only tiles touching one of them are yielded.
+    """
+    yield 0, 0, image
+    width, height = image.size
+    stride = max(1, int(tile_size * (1 - overlap)))
+    for y in _tile_starts(height, tile_size, stride):
+        for x in _tile_starts(width, tile_size, stride):
+            x2, y2 = min(x + tile_size, width), min(y + tile_size, height)
+            if regions is not None and not any(
+                rx1 < x2 and rx2 > x and ry1 < y2 and ry2 > y for rx1, ry1, rx2, ry2 in regions
+            ):
+                continue
+            yield x, y, image.crop((x, y, x2, y2))
+
+def _drop_contained(boxes, class_ids, thresh=TILE_CONTAIN_THRESHOLD):
+    """Indices of boxes not mostly inside a higher-scoring box of the same class.
+
+    Expects boxes sorted by descending score, as nms_indices returns them.
+    This removes the partial box left by a bird cut at a tile seam, which
+    IoU alone does not suppress.
+    """
+    areas = np.maximum((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]), 1e-9)
+    keep = []
+    for i in range(len(boxes)):
+        if keep:
+            kept = np.array(keep)
+            inter_w = np.maximum(0.0, np.minimum(boxes[i, 2], boxes[kept, 2]) - np.maximum(boxes[i, 0], boxes[kept, 0]))
+            inter_h = np.maximum(0.0, np.minimum(boxes[i, 3], boxes[kept, 3]) - np.maximum(boxes[i, 1], boxes[kept, 1]))
+            contained = (inter_w * inter_h / areas[i] > thresh) & (class_ids[kept] == class_ids[i])
+            if contained.any():
+                continue
+        keep.append(i)
+    return np.array(keep, dtype=np.int64)
+
+def run_inference_tiled(image, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, batch_size=BATCH_SIZE, regions=None):
+    """Detect on overlapping tiles so small, distant birds in very large images survive.
+
+    Tiles are cropped lazily and pushed through the model batch_size at a
+    time, so memory beyond the decoded image is bounded by one batch. A
+    whole-image pass is included for birds larger than a tile. Detections
+    from all tiles are merged with one global NMS. regions restricts the
+    tiles to those touching the given boxes.
+    """
+    image = load_image(image)
+    model = get_model()
+    fixed_batch = model_batch_size(model.session)
+    batch_size = fixed_batch or batch_size
+    input_name = model.session.get_inputs()[0].name
+
+    tiles = _tiles(image, tile_size, overlap, regions)
+    boxes, scores, class_ids = [], [], []
+    while True:
+        chunk = list(itertools.islice(tiles, batch_size))
+        if not chunk:
+            break
 
-def draw_detections(image_path, detections, output_path):
-    image = Image.open(image_path).convert("RGB")
+        input_tensor = input_buffer(fixed_batch or len(chunk))
+        geometries = [preprocess(crop, out=input_tensor[i])[1] for i, (_, _, crop) in enumerate(chunk)]
+        input_tensor[len(chunk):] = 0
+        output = model.session.run(None, {input_name: input_tensor})
+
+        for i, ((x, y, _), geometry) in enumerate(zip(chunk, geometries)):
+            tile_boxes, tile_scores, tile_class_ids = decode_output([output[0][i:i + 1]], geometry, len(model.labels))
+            tile_boxes += [x, y, x, y]
+            boxes.append(tile_boxes)
+            scores.append(tile_scores)
+            class_ids.append(tile_class_ids)
+
+    boxes, scores, class_ids = np.concatenate(boxes), np.concatenate(scores), np.concatenate(class_ids)
+    keep = nms_indices(boxes, scores, class_ids)
+    boxes, scores, class_ids = boxes[keep], scores[keep], class_ids[keep]
+    keep = _drop_contained(boxes, class_ids)
+    return build_detections(boxes[keep], scores[keep], class_ids[keep], model.labels)
+
+def model_accepts_size(session, size):
+    """Whether the model takes size x size inputs, i.e. its spatial dimensions are dynamic or equal to size"""
+    height, width = session.get_inputs()[0].shape[2:4]
+    return all(not isinstance(dim, int) or dim == size for dim in (height, width))
+
+def run_inference_cascade(image):
+    """Coarse-to-fine detection: a cheap low-resolution pass decides whether the full pass is needed.
+
+    Returns the detections and the stage that decided them: "coarse" when the
+    CASCADE_SIZE pass found no candidate above CASCADE_THRESHOLD, "fine" when
+    the full-resolution pass ran (only on tiles around the candidates for
+    images that get tiled), or "full" when the cascade is off or the model
+    only accepts INPUT_SIZE inputs.
+    """
+    image = load_image(image)
+    model = get_model()
+    if not CASCADE_ENABLED or not model_accepts_size(model.session, CASCADE_SIZE):
+        return run_inference(image), "full"
+
+    input_tensor, geometry = preprocess(image, size=CASCADE_SIZE)
+    input_name = model.session.get_inputs()[0].name
+    output = model.session.run(None, {input_name: input_tensor})
+    boxes, _, _ = decode_output(output, geometry, len(model.labels), conf_thresh=CASCADE_THRESHOLD)
+    if not len(boxes):
+        return [], "coarse"
+
+    width, height = image.size
+    if width * height >= TILING_MIN_PIXELS:
+        margin = np.tile(np.maximum(boxes[:, 2:] - boxes[:, :2], 1.0) * CASCADE_REGION_MARGIN, 2)
+        regions = (boxes + margin * [-1, -1, 1, 1]).tolist()
+        return run_inference_tiled(image, regions=regions), "fine"
+    return run_inference(image, tiled=False), "fine"
+
+def draw_detections(image, detections, output_path=None, image_format="JPEG", copy=True):
+    """Draw boxes on the image (on a copy unless copy=False) and return it.
+
+    The result is also saved when output_path is given, either a file path
+    or a writable buffer (encoded as image_format).
+    """
+    image = load_image(image)
+    if copy:
+        image = image.copy()
     draw = ImageDraw.Draw(image)
 
     try:
@@ -154,34 +401,375 @@ def draw_detections(image_path, detections, output_path):
         draw.rectangle([x1, y1, x2, y2], outline="red", width=2)
         draw.text((x1, y1 - 10), label, fill="red", font=font)
 
-    image.save(output_path)
+    if output_path is not None:
+        image.save(output_path, format=None if isinstance(output_path, str) else image_format)
 
-def process_video(video_path, output_path):
+    return image
+
+def draw_detections_frame(frame, detections):
+    """Draw boxes directly onto a BGR video frame, in place"""
+    for det in detections:
+        x1, y1, x2, y2 = (int(round(v)) for v in det["bbox"])
+        label = f"{det['label']} {det['confidence']:.2f}"
+        cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 0, 255), 2)
+        cv2.putText(frame, label, (x1, max(y1 - 4, 10)), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1)
+
+    return frame
+
+def is_warmup_event(event):
+    """Scheduled pings and explicit {"warmup": true} invocations only prime the container"""
+    return isinstance(event, dict) and (event.get("warmup") is True or event.get("source") == "aws.events")
+
+def warm_up(timer):
+    """Load the model and push a synthetic image through every path a request can take.
+
+    ONNX Runtime allocates on the first run of each input shape, so the full
+    size, cascade and video batch shapes are all run once. Steps are timed
+    as stages of timer.
+    """
+    with timer.stage("model"):
+        model = get_model()
+    timer.set(model_version=f"{model.version}-{model.variant}")
+
+    rgb = np.random.default_rng(0).integers(0, 256, (WARMUP_SIZE[1], WARMUP_SIZE[0], 3), dtype=np.uint8)
+    image = Image.fromarray(rgb)
+    with timer.stage("image"):
+        draw_detections(image, run_inference(image), io.BytesIO())
+    with timer.stage("cascade"):
+        run_inference_cascade(image)
+    with timer.stage("video_batch"):
+        frame = np.ascontiguousarray(rgb[:, :, ::-1])
+        run_inference_batch([frame] * VIDEO_BATCH_SIZE, VIDEO_BATCH_SIZE, preprocess_frame)
+    return model
+
+class MotionGate:
+    """Cheap check for whether a video frame changed enough to be worth running the detector on.
+
+    Frames are compared, downscaled and greyscale, against the last frame that
+    passed the gate, so slow drift still accumulates into a change.
+    """
+
+    def __init__(self, threshold=MOTION_THRESHOLD, pixel_delta=MOTION_PIXEL_DELTA):
+        self.threshold = threshold
+        self.pixel_delta = pixel_delta
+        self.reference = None
+
+    def changed(self, frame):
+        if self.threshold <= 0:
+            return True
+
+        small = cv2.resize(frame, MOTION_SIZE, interpolation=cv2.INTER_AREA)
+        small = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (3, 3), 0)
+        if self.reference is not None:
+            moving = np.count_nonzero(cv2.absdiff(small, self.reference) > self.pixel_delta)
+            if moving / small.size < self.threshold:
+                return False
+
+        self.reference = small
+        return True
+
+def box_iou(boxes_a, boxes_b):
+    """Pairwise IoU between two (N, 4) and (M, 4) arrays of x1, y1, x2, y2 boxes"""
+    boxes_a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float64).reshape(-1, 4)
+
+    xx1 = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    yy1 = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    xx2 = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    yy2 = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+    inter = np.maximum(0.0, xx2 - xx1) * np.maximum(0.0, yy2 - yy1)
+
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-9), 0.0)
+
+class IouTracker:
+    """Greedy IoU/centroid tracker that keeps bird identities across frames.
+
+    Tracks move with constant velocity between detector updates, so boxes can
+    be propagated on frames where the detector was skipped.
+    """
+
+    def __init__(self, iou_thresh=TRACK_IOU_THRESHOLD, max_misses=TRACK_MAX_MISSES):
+        self.iou_thresh = iou_thresh
+        self.max_misses = max_misses
+        self.active = []
+        self.all_tracks = []
+        self._next_id = 1
+
+    def _box_at(self, track, frame_idx):
+        return track["box"] + track["velocity"] * (frame_idx - track["frame_idx"])
+
+    def _as_detection(self, track, box):
+        return {
+            "class_id": track["class_id"],
+            "label": track["label"],
+            "confidence": track["confidence"],
+            "bbox": box.tolist(),
+            "track_id": track["track_id"]
+        }
+
+    def _match(self, predicted, boxes, class_ids):
+        """Greedy matching on IoU, then on centroid distance for whatever is left"""
+        matches = []
+        if not len(predicted) or not len(boxes):
+            return matches
+
+        same_class = np.array([t["class_id"] for t in self.active])[:, None] == class_ids[None, :]
+        iou = np.where(same_class, box_iou(predicted, boxes), 0.0)
+        for t, d in zip(*np.unravel_index(np.argsort(-iou, axis=None), iou.shape)):
+            if iou[t, d] < self.iou_thresh:
+                break
+            if all(t != mt and d != md for mt, md in matches):
+                matches.append((t, d))
+
+        # Fast birds can jump clear of their old box; fall back to centroids
+        centers_t = (predicted[:, :2] + predicted[:, 2:]) / 2
+        centers_d = (boxes[:, :2] + boxes[:, 2:]) / 2
+        sizes = np.maximum(predicted[:, 2] - predicted[:, 0], predicted[:, 3] - predicted[:, 1])
+        dist = np.linalg.norm(centers_t[:, None] - centers_d[None, :], axis=2)
+        dist = np.where(same_class & (dist < sizes[:, None]), dist, np.inf)
+        for t, d in zip(*np.unravel_index(np.argsort(dist, axis=None), dist.shape)):
+            if not np.isfinite(dist[t, d]):
+                break
+            if all(t != mt and d != md for mt, md in matches):
+                matches.append((t, d))
+
+        return matches
+
+    def update(self, detections, frame_idx):
+        """Associate fresh detections with tracks and return them tagged with track ids"""
+        boxes = np.array([d["bbox"] for d in detections], dtype=np.float64).reshape(-1, 4)
+        class_ids = np.array([d["class_id"] for d in detections], dtype=np.int64)
+        predicted = np.array([self._box_at(t, frame_idx) for t in self.active]).reshape(-1, 4)
+
+        matched_tracks = set()
+        matched_dets = {}
+        for t, d in self._match(predicted, boxes, class_ids):
+            track = self.active[t]
+            elapsed = frame_idx - track["frame_idx"]
+            if elapsed > 0:
+                track["velocity"] = (boxes[d] - track["box"]) / elapsed
+            track.update(box=boxes[d], frame_idx=frame_idx, misses=0,
+                         confidence=detections[d]["confidence"])
+            track["hits"] += 1
+            matched_tracks.add(t)
+            matched_dets[d] = track
+
+        for t, track in enumerate(self.active):
+            if t not in matched_tracks:
+                track["misses"] += 1
+        self.active = [t for t in self.active if t["misses"] <= self.max_misses]
+
+        results = []
+        for d, det in enumerate(detections):
+            track = matched_dets.get(d)
+            if track is None:
+                track = {
+                    "track_id": self._next_id,
+                    "class_id": det["class_id"],
+                    "label": det["label"],
+                    "confidence": det["confidence"],
+                    "box": boxes[d],
+                    "velocity": np.zeros(4),
+                    "frame_idx": frame_idx,
+                    "misses": 0,
+                    "hits": 1
+                }
+                self._next_id += 1
+                self.active.append(track)
+                self.all_tracks.append(track)
+            results.append({**det, "track_id": track["track_id"]})
+
+        return results
+
+    def predict(self, frame_idx):
+        """Propagate live tracks to a frame the detector did not see"""
+        return [
+            self._as_detection(t, self._box_at(t, frame_idx))
+            for t in self.active if t["misses"] == 0
+        ]
+
+class KeyframeDetector:
+    """Runs the detector on every keyframe_interval-th frame and tracks in between.
+
+    Keyframes that the motion gate considers static are skipped too, reusing
+    the previous frame's detections.
+    """
+
+    def __init__(self, keyframe_interval=KEYFRAME_INTERVAL, batch_size=VIDEO_BATCH_SIZE, detect_fn=None,
+                 min_track_hits=MIN_TRACK_HITS):
+        self.keyframe_interval = max(1, keyframe_interval)
+        self.batch_size = batch_size
+        self.min_track_hits = max(1, min_track_hits)
+        self.detect_fn = detect_fn or (
+            lambda frames: run_inference_batch(frames, self.batch_size, preprocess_frame)
+        )
+        self.tracker = IouTracker()
+        self.gate = MotionGate()
+        self.frame_idx = 0
+        self.inference_frames = 0
+        self.skipped_frames = 0
+        self._previous = []
+
+    def process(self, frames):
+        """Return one detection list per frame, in order"""
+        keyframes = [
+            i for i in range(len(frames))
+            if (self.frame_idx + i) % self.keyframe_interval == 0
+        ]
+        static = {i for i in keyframes if not self.gate.changed(frames[i])}
+        keyframes = [i for i in keyframes if i not in static]
+        key_results = dict(zip(keyframes, self.detect_fn([frames[i] for i in keyframes]) if keyframes else []))
+        self.inference_frames += len(keyframes)
+        self.skipped_frames += len(static)
+
+        results = []
+        for i in range(len(frames)):
+            if i in key_results:
+                self._previous = self.tracker.update(key_results[i], self.frame_idx)
+            elif i not in static:
+                self._previous = self.tracker.predict(self.frame_idx)
+            results.append(self._previous)
+            self.frame_idx += 1
+        return results
+
+    def tracks(self):
+        """One entry per bird track, so per-species counts are a Counter away.
+
+        Only tracks the detector confirmed on at least min_track_hits
+        keyframes count, which drops one-off false positives. Clips with
+        fewer detector calls than that lower the bar to what was possible.
+        Counts are still an upper bound: a bird that is occluded or leaves
+        the frame for more than TRACK_MAX_MISSES detector calls comes back
+        under a new track id and is counted again.
+        """
+        min_hits = min(self.min_track_hits, max(1, self.inference_frames))
+        return [
+            {"label": t["label"], "track_id": t["track_id"], "hits": t["hits"]}
+            for t in self.tracker.all_tracks if t["hits"] >= min_hits
+        ]
+
+def _decode_stage(cap, frames, stop, busy):
+    try:
+        while not stop.is_set():
+            start = time.perf_counter()
+            ret, frame = cap.read()
+            busy["decode"] += time.perf_counter() - start
+            if not ret:
+                break
+            frames.put(frame)
+    finally:
+        frames.put(None)
+
+def _encode_stage(out, annotated, busy, errors):
+    while True:
+        item = annotated.get()
+        if item is None:
+            return
+        if errors:
+            # Keep draining so the inference stage never blocks on a dead writer
+            continue
+        try:
+            start = time.perf_counter()
+            frame, detections = item
+            out.write(draw_detections_frame(frame, detections))
+            busy["encode"] += time.perf_counter() - start
+        except Exception as e:
+            errors.append(e)
+
+def process_video(video_path, output_path, batch_size=VIDEO_BATCH_SIZE, keyframe_interval=KEYFRAME_INTERVAL,
+                  frame_detections=None):
+    """Detect and annotate every frame of a video.
+
+    Decoding and encoding run on their own threads, connected to the inference
+    stage by bounded queues so memory stays flat however long the clip is.
+    Frame order is preserved. The detector runs on every keyframe_interval-th
+    frame, with boxes tracked in between. Returns one entry per tracked bird
+    and a stats dict with frames/sec and per-stage utilisation. Each frame's
+    detections are also appended to frame_detections when it is a list. With
+    output_path=None nothing is drawn or encoded, only detected.
+    """
     cap = cv2.VideoCapture(video_path)
     width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
     fps = cap.get(cv2.CAP_PROP_FPS)
 
-    out = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
-    bird_types_found = set()
+    out = None
+    if output_path is not None:
+        out = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    detector = KeyframeDetector(keyframe_interval, batch_size)
 
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
+    frames = queue.Queue(maxsize=VIDEO_QUEUE_SIZE)
+    annotated = queue.Queue(maxsize=VIDEO_QUEUE_SIZE)
+    busy = {"decode": 0.0, "inference": 0.0, "encode": 0.0}
+    stop = threading.Event()
+    errors = []
 
-        pil_image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-        tmp_path = "/tmp/frame.jpg"
-        pil_image.save(tmp_path)
-        detections = run_inference(tmp_path)
-        bird_types_found.update(d["label"] for d in detections)
+    decoder = threading.Thread(target=_decode_stage, args=(cap, frames, stop, busy), daemon=True)
+    encoder = threading.Thread(target=_encode_stage, args=(out, annotated, busy, errors), daemon=True)
 
-        draw_detections(tmp_path, detections, tmp_path)
-        annotated = Image.open(tmp_path)
-        annotated_frame = cv2.cvtColor(np.array(annotated), cv2.COLOR_RGB2BGR)
-        out.write(annotated_frame)
+    frame_count = 0
+    decoded_all = False
+    wall_start = time.perf_counter()
+    decoder.start()
+    if out is not None:
+        encoder.start()
 
-    cap.release()
-    out.release()
-
-    return [{"label": label} for label in bird_types_found]
+    try:
+        while not decoded_all:
+            batch = []
+            while len(batch) < batch_size:
+                frame = frames.get()
+                if frame is None:
+                    decoded_all = True
+                    break
+                batch.append(frame)
+            if not batch:
+                break
+
+            start = time.perf_counter()
+            results = detector.process(batch)
+            busy["inference"] += time.perf_counter() - start
+
+            if out is not None:
+                for frame, detections in zip(batch, results):
+                    annotated.put((frame, detections))
+            if frame_detections is not None:
+                frame_detections.extend(results)
+            frame_count += len(batch)
+    except Exception:
+        stop.set()
+        if not decoded_all:
+            while frames.get() is not None:
+                pass
+        raise
+    finally:
+        if out is not None:
+            annotated.put(None)
+            encoder.join()
+            out.release()
+        decoder.join()
+        cap.release()
+
+    if errors:
+        raise errors[0]
+
+    wall = time.perf_counter() - wall_start
+    stats = {
+        "frames": frame_count,
+        "frame_size": [width, height],
+        "video_fps": fps,
+        "seconds": round(wall, 3),
+        "fps": round(frame_count / wall, 2) if wall > 0 else 0.0,
+        "batch_size": batch_size,
+        "keyframe_interval": detector.keyframe_interval,
+        "inference_frames": detector.inference_frames,
+        "skipped_frames": detector.skipped_frames,
+        "tracks": len(detector.tracker.all_tracks),
+        "utilisation": {stage: round(seconds / wall, 3) if wall > 0 else 0.0 for stage, seconds in busy.items()},
+    }
+    logger.info(f"Video processed: {stats}")
+
+    return detector.tracks(), stats
@@ -2,6 +2,7 @@ import boto3
 import os
 import json
 from urllib.parse import urlparse
+from metrics import invocation
 
 s3 = boto3.client('s3')
 BUCKET_NAME = os.environ['BUCKET_NAME']
@@ -10,8 +11,18 @@ dynamodb = boto3.resource('dynamodb')
 table = dynamodb.Table(os.environ['TABLE_NAME'])
 
 audio_extensions = ["wav", "x-wav", "mp3"]
+# Same as the tagging Lambda's VIDEO_EXTENSIONS
+video_extensions = ["mp4", "avi", "mov", "mkv"]
+# Stored detections written next to annotated outputs by the tagging Lambda
+DETECTION_RECORD_SUFFIX = ".detections.json.gz"
 
 def delete_file(event, context):
+    with invocation("delete") as timer:
+        response = delete_files(event, timer)
+        timer.set(status_code=response["statusCode"])
+        return response
+
+def delete_files(event, timer):
     body = json.loads(event.get("body", "{}"))
     s3_urls = body.get("urls", [])
 
@@ -25,39 +36,47 @@ def delete_file(event, context):
             print(file_name, file_base, file_ext)
 
             is_audio = file_ext.lower() in audio_extensions
-            is_video = file_ext.lower() == "mp4"
+            is_video = file_ext.lower() in video_extensions
 
             if is_audio:
                 raw_key = f"audio/{file_name}"
                 annotated_key = f"annotated/audio/{file_base}_predictions.json"
-
-                s3.delete_object(Bucket=BUCKET_NAME, Key=raw_key)
-                s3.delete_object(Bucket=BUCKET_NAME, Key=annotated_key)
-                delete_from_dynamo(raw_key)
+                keys = [raw_key, annotated_key]
 
             elif is_video:
                 raw_key = f"uploads/{file_name}"
-                annotated_key = f"annotated/video/{file_base}.mp4"
-
-                s3.delete_object(Bucket=BUCKET_NAME, Key=raw_key)
-                s3.delete_object(Bucket=BUCKET_NAME, Key=annotated_key)
-                delete_from_dynamo(raw_key)
+                # The tagging Lambda keeps the upload's name and extension
+                annotated_key = f"annotated/videos/{file_name}"
+                keys = [raw_key, annotated_key, annotated_key + DETECTION_RECORD_SUFFIX]
 
             else:
                 raw_key = f"uploads/{file_name}"
                 annotated_key = f"annotated/images/{file_name}"
                 thumbnail_key = f"thumbnails/{file_name}"
-
-                s3.delete_object(Bucket=BUCKET_NAME, Key=raw_key)
-                s3.delete_object(Bucket=BUCKET_NAME, Key=annotated_key)
-                s3.delete_object(Bucket=BUCKET_NAME, Key=thumbnail_key)
-                delete_from_dynamo(raw_key)
+                keys = [raw_key, annotated_key, thumbnail_key, annotated_key + DETECTION_RECORD_SUFFIX]
+
+            with timer.stage("dynamodb"):
+                items = find_items(raw_key)
+            # Also remove the annotated output ingest actually recorded, should it differ
+            for item in items:
+                stored_key = stored_annotated_key(item)
+                if stored_key and stored_key not in keys:
+                    keys += [stored_key] if is_audio else [stored_key, stored_key + DETECTION_RECORD_SUFFIX]
+
+            with timer.stage("s3_delete"):
+                for key in keys:
+                    s3.delete_object(Bucket=BUCKET_NAME, Key=key)
+            with timer.stage("dynamodb"):
+                for item in items:
+                    table.delete_item(Key={'file_id': item['file_id']})
 
             deleted.append(file_name)
 
         except Exception as e:
             errors.append({"url": url, "error": str(e)})
 
+    timer.value("deleted_files", len(deleted))
+    timer.value("failed_files", len(errors))
     return {
         "statusCode": 200 if not errors else 207,
         "body": json.dumps({
@@ -70,11 +89,16 @@ def extract_file_name(url):
     parsed = urlparse(url)
     return os.path.basename(parsed.path)
 
-def delete_from_dynamo(raw_key):
+def find_items(raw_key):
     full_url = f"s3://{BUCKET_NAME}/{raw_key}"
     response = table.scan(
         FilterExpression=boto3.dynamodb.conditions.Attr('original_s3_url').eq(full_url)
     )
-    items = response.get('Items', [])
-    for item in items:
-        table.delete_item(Key={'file_id': item['file_id']})
+    return response.get('Items', [])
+
+def stored_annotated_key(item):
+    """Key of an item's annotated output in BUCKET_NAME, None if it has none there"""
+    parsed = urlparse(item.get('annotated_s3_url') or "")
+    if parsed.scheme != "s3" or parsed.netloc != BUCKET_NAME:
+        return None
+    return parsed.path.lstrip("/")
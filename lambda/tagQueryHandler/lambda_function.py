@@ -1,9 +1,13 @@
 import json
+import os
 import base64
 import tempfile
 import boto3
+from botocore.exceptions import ClientError
 from decimal import Decimal
-from utils import run_inference, process_video
+from utils import run_inference, process_video, get_model, detection_cache, is_warmup_event, warm_up
+from detection_cache import model_tag, IMAGE_FULL
+from metrics import invocation
 import logging
 
 logger = logging.getLogger()
@@ -12,6 +16,9 @@ logger.setLevel(logging.INFO)
 dynamodb = boto3.resource("dynamodb")
 table = dynamodb.Table("BirdTagsData")
 s3 = boto3.client("s3")
+lambda_client = boto3.client("lambda")
+# Renders annotated copies of files ingested without eager annotation
+RENDER_FUNCTION = os.environ.get("ANNOTATION_RENDER_FUNCTION", "birdTagLambda")
 
 class DecimalEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -33,12 +40,91 @@ def generate_presigned_url(s3_uri):
         logger.error(f"Presigned URL error for {s3_uri}: {e}")
         return None
 
+def object_exists(s3_uri):
+    bucket, key = s3_uri.replace("s3://", "").split("/", 1)
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+def annotated_links(item):
+    """Annotated URL fields for a search result.
+
+    Searches never render. A lazily annotated file that has not been
+    rendered yet gets no URL, a pending status and the request that renders
+    it when the user opens it. Any failure leaves the URL as None.
+    """
+    s3_uri = item.get("annotated_s3_url")
+    try:
+        if item.get("annotation") == "lazy" and s3_uri and not object_exists(s3_uri):
+            return {
+                "annotated_url": None,
+                "annotation_status": "pending",
+                "render_request": {"annotated_s3_url": s3_uri}
+            }
+        return {"annotated_url": generate_presigned_url(s3_uri)}
+    except Exception as e:
+        logger.error(f"Annotated URL error for {s3_uri}: {e}")
+        return {"annotated_url": None}
+
+def open_annotated(s3_uri, timer):
+    """Render one lazily annotated file, if it has not been already, and presign it"""
+    if not s3_uri.startswith("s3://") or not s3_uri.replace("s3://", "").split("/", 1)[-1].startswith("annotated/"):
+        return {"statusCode": 400, "body": json.dumps({"error": "Invalid 'annotated_s3_url'"})}
+
+    with timer.stage("render"):
+        response = lambda_client.invoke(
+            FunctionName=RENDER_FUNCTION,
+            Payload=json.dumps({"action": "render", "annotated_s3_url": s3_uri}).encode("utf-8")
+        )
+        payload = json.loads(response["Payload"].read())
+    if payload.get("statusCode") != 200:
+        logger.error(f"Rendering {s3_uri} failed: {payload}")
+        return {"statusCode": 502, "body": json.dumps({"error": "Rendering failed"})}
+    return {"statusCode": 200, "body": payload["body"]}
+
+def handle_warmup():
+    """Prime the model for a scheduled ping or provisioned concurrency, reporting how long each step took"""
+    with invocation("tagQueryHandler.warmup") as timer:
+        model = warm_up(timer)
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "warmup": True,
+            "cold_start": timer.cold_start,
+            "model_version": model.version,
+            "model_variant": model.variant,
+            "timings_ms": {stage: round(ms, 1) for stage, ms in timer.stages.items()}
+        })
+    }
+
 def lambda_handler(event, context):
+    if is_warmup_event(event):
+        return handle_warmup()
+
+    with invocation("tagQueryHandler") as timer:
+        try:
+            body = json.loads(event.get("body") or "{}")
+        except ValueError:
+            body = {}  # search_by_file reports the bad body
+        if isinstance(body, dict) and "annotated_s3_url" in body:
+            # The render_request of a pending search result: the user opened that file
+            response = open_annotated(body["annotated_s3_url"], timer)
+        else:
+            response = search_by_file(event, timer)
+        timer.set(status_code=response["statusCode"])
+        return response
+
+def search_by_file(event, timer):
     try:
         # Decode base64 file
         body = json.loads(event.get("body", "{}"))
         file_b64 = body.get("file_base64")
         file_type = body.get("file_type", "image")  # "image" or "video"
+        timer.set(file_type=file_type)
 
         if not file_b64:
             return {
@@ -46,33 +132,49 @@ def lambda_handler(event, context):
                 "body": json.dumps({"error": "Missing 'file_base64'"})
             }
 
-        file_bytes = base64.b64decode(file_b64)
+        with timer.stage("decode"):
+            file_bytes = base64.b64decode(file_b64)
+        timer.value("payload_bytes", len(file_bytes), "Bytes")
         logger.info("File decoded successfully, length: %d bytes", len(file_bytes))
 
         tags = []
+        video_stats = {}
+        with timer.stage("model"):
+            version_tag = model_tag(get_model())
+        timer.set(model_version=version_tag)
 
         if file_type == "video":
-            with tempfile.NamedTemporaryFile(suffix=".mp4", delete=True) as tmp:
-                tmp.write(file_bytes)
-                tmp.flush()
-                tags = process_video(tmp.name)
+            def detect_video():
+                with tempfile.NamedTemporaryFile(suffix=".mp4", delete=True) as tmp:
+                    tmp.write(file_bytes)
+                    tmp.flush()
+                    tags, stats = process_video(tmp.name)
+                video_stats.update(stats)
+                return tags
+
+            with timer.stage("inference"):
+                tags, cache_tier = detection_cache.get_or_compute(file_bytes, version_tag, "video-tags", detect_video)
         else:
-            with tempfile.NamedTemporaryFile(suffix=".jpg", delete=True) as tmp:
-                tmp.write(file_bytes)
-                tmp.flush()
-                results = run_inference(tmp.name)  # returns list of dicts
-                tags = [r["label"].lower() for r in results if "label" in r]
+            # Full-pass results are shared with the tagging Lambda, which also writes
+            # them when its cascade falls back to the full pass
+            with timer.stage("inference"):
+                results, cache_tier = detection_cache.get_or_compute(
+                    file_bytes, version_tag, IMAGE_FULL, lambda: run_inference(file_bytes)
+                )
+            tags = [r["label"].lower() for r in results if "label" in r]
+        timer.set(cache=cache_tier or "miss")
 
-        logger.info("Inference completed, detected tags: %s", tags)
+        logger.info("Inference completed (cache: %s), detected tags: %s", cache_tier or "miss", tags)
 
         if not tags:
             return {
                 "statusCode": 200,
-                "body": json.dumps({"matched_files": [], "count": 0})
+                "body": json.dumps({"matched_files": [], "count": 0, "cache_hit": cache_tier is not None, **video_stats})
             }
 
         # Query DynamoDB for matching records
-        response = table.scan()
+        with timer.stage("dynamodb"):
+            response = table.scan()
         matched_results = []
 
         for item in response.get("Items", []):
@@ -80,20 +182,24 @@ def lambda_handler(event, context):
             detected_labels = {d.get("label", "").lower() for d in detected if "label" in d}
 
             if all(tag in detected_labels for tag in tags):
-                result = {
-                    "filename": item.get("filename"),
-                    "thumbnail_url": generate_presigned_url(item.get("thumbnail_s3_url")),
-                    "annotated_url": generate_presigned_url(item.get("annotated_s3_url")),
-                    "original_url": generate_presigned_url(item.get("original_s3_url")),
-                    "tags": [d.get("label") for d in detected]
-                }
+                with timer.stage("presign"):
+                    result = {
+                        "filename": item.get("filename"),
+                        "thumbnail_url": generate_presigned_url(item.get("thumbnail_s3_url")),
+                        **annotated_links(item),
+                        "original_url": generate_presigned_url(item.get("original_s3_url")),
+                        "tags": [d.get("label") for d in detected]
+                    }
                 matched_results.append(result)
+        timer.value("matched_files", len(matched_results))
 
         return {
             "statusCode": 200,
             "body": json.dumps({
                 "matched_files": matched_results,
-                "count": len(matched_results)
+                "count": len(matched_results),
+                "cache_hit": cache_tier is not None,
+                **video_stats
             }, cls=DecimalEncoder)
         }
 
@@ -0,0 +1,287 @@
+"""Versioned local cache of the detection model.
+
+Models live under MODEL_CACHE_DIR/<version>/, each file with a recorded
+SHA-256 so a truncated or stale copy in /tmp is never reused. The model is
+loaded on first use rather than at import, and the published version is
+re-checked every VERSION_CHECK_SECONDS so a warm container picks up a
+version bump without a cold restart.
+
+Sessions are tuned by a named performance profile (ORT_PROFILE). The graph
+ONNX Runtime optimizes for a profile is saved next to the model, and
+published back to S3 when the role allows it, so later cold starts load it
+directly instead of optimizing again.
+
+MODEL_VARIANT selects which file of a version is run: the FP32 export or
+the INT8 model built from it by quantize.py. A version without the
+requested variant falls back to FP32.
+"""
+import hashlib
+import json
+import logging
+import os
+import platform
+import shutil
+import threading
+import time
+from collections import namedtuple
+
+import boto3
+import onnxruntime as ort
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+MODEL_S3_BUCKET = "team99-bird-detection-models"
+MODEL_S3_PREFIX = "birdTagging"
+MODEL_CACHE_DIR = "/tmp/models"
+VERSION_CHECK_SECONDS = int(os.environ.get("MODEL_VERSION_CHECK_SECONDS", "300"))
+ORT_PROFILE = os.environ.get("ORT_PROFILE", "latency")
+PUBLISH_OPTIMIZED = os.environ.get("ORT_PUBLISH_OPTIMIZED", "1") == "1"
+MODEL_VARIANT = os.environ.get("MODEL_VARIANT", "fp32")
+MODEL_VARIANTS = {
+    "fp32": "model.onnx",
+    "int8": "model.int8.onnx",
+}
+
+# Thread counts are functions of the vCPUs this Lambda size actually gets.
+# "baseline" is the configuration the detector used before profiles existed.
+PERFORMANCE_PROFILES = {
+    "baseline": {
+        "intra_op_threads": lambda cpus: 0,
+        "inter_op_threads": lambda cpus: 0,
+        "execution_mode": ort.ExecutionMode.ORT_SEQUENTIAL,
+        "graph_optimization": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+        "mem_pattern": False,
+    },
+    # One request at a time: every core on each operator, no inter-op overhead
+    "latency": {
+        "intra_op_threads": lambda cpus: cpus,
+        "inter_op_threads": lambda cpus: 1,
+        "execution_mode": ort.ExecutionMode.ORT_SEQUENTIAL,
+        "graph_optimization": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+        "mem_pattern": True,
+    },
+    # Batched frames: run independent branches of the graph side by side
+    "throughput": {
+        "intra_op_threads": lambda cpus: max(1, cpus // 2),
+        "inter_op_threads": lambda cpus: 2 if cpus > 1 else 1,
+        "execution_mode": ort.ExecutionMode.ORT_PARALLEL,
+        "graph_optimization": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+        "mem_pattern": False,
+    },
+}
+
+LoadedModel = namedtuple("LoadedModel", ["session", "labels", "version", "variant"])
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def profile_settings(profile):
+    """Resolved settings of a performance profile on this machine"""
+    if profile not in PERFORMANCE_PROFILES:
+        raise ValueError(f"Unknown ORT profile {profile!r}, expected one of {sorted(PERFORMANCE_PROFILES)}")
+    settings = PERFORMANCE_PROFILES[profile]
+    cpus = available_cpus()
+    return {
+        **settings,
+        "intra_op_threads": settings["intra_op_threads"](cpus),
+        "inter_op_threads": settings["inter_op_threads"](cpus),
+    }
+
+
+def optimized_model_name(profile, model_name=MODEL_VARIANTS["fp32"]):
+    """Optimized graphs are only valid for the same source model, optimization level, ORT build and CPU architecture"""
+    level = profile_settings(profile)["graph_optimization"]
+    stem = os.path.splitext(model_name)[0]
+    return f"{stem}.opt{int(level)}.ort{ort.__version__}.{platform.machine()}.onnx"
+
+
+def create_session(model_path, profile=ORT_PROFILE, optimized_path=None):
+    """Create a CPU session for a profile.
+
+    With optimized_path, an existing optimized graph there is loaded as-is,
+    otherwise the graph optimized for this session is saved there.
+    """
+    settings = profile_settings(profile)
+
+    session_options = ort.SessionOptions()
+    session_options.enable_mem_pattern = settings["mem_pattern"]
+    session_options.enable_cpu_mem_arena = True
+    session_options.log_severity_level = 3
+    session_options.log_verbosity_level = 0
+    session_options.intra_op_num_threads = settings["intra_op_threads"]
+    session_options.inter_op_num_threads = settings["inter_op_threads"]
+    session_options.execution_mode = settings["execution_mode"]
+    session_options.graph_optimization_level = settings["graph_optimization"]
+
+    if optimized_path and os.path.exists(optimized_path):
+        model_path = optimized_path
+        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+    elif optimized_path:
+        session_options.optimized_model_filepath = optimized_path
+
+    return ort.InferenceSession(
+        model_path,
+        sess_options=session_options,
+        providers=["CPUExecutionProvider"]
+    )
+
+
+class ModelStore:
+    def __init__(self, bucket=MODEL_S3_BUCKET, prefix=MODEL_S3_PREFIX, cache_dir=MODEL_CACHE_DIR,
+                 check_seconds=VERSION_CHECK_SECONDS, profile=ORT_PROFILE, variant=MODEL_VARIANT,
+                 s3_client=None):
+        if variant not in MODEL_VARIANTS:
+            raise ValueError(f"Unknown model variant {variant!r}, expected one of {sorted(MODEL_VARIANTS)}")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.cache_dir = cache_dir
+        self.check_seconds = check_seconds
+        self.profile = profile
+        self.variant = variant
+        self._s3 = s3_client
+        self._model = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def s3(self):
+        if self._s3 is None:
+            self._s3 = boto3.client("s3")
+        return self._s3
+
+    def current_version(self):
+        obj = self.s3.get_object(Bucket=self.bucket, Key=f"{self.prefix}/current_version.txt")
+        return obj["Body"].read().decode("utf-8").strip()
+
+    def _published_digest(self, key):
+        """SHA-256 uploaded next to an artifact as <key>.sha256, if there is one"""
+        try:
+            obj = self.s3.get_object(Bucket=self.bucket, Key=key + ".sha256")
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None
+            raise
+        return obj["Body"].read().decode("utf-8").split()[0].lower()
+
+    def fetch(self, version, name):
+        """Local path of a model artifact, downloading it if the cached copy is missing or corrupt"""
+        key = f"{self.prefix}/models/{version}/{name}"
+        version_dir = os.path.join(self.cache_dir, version)
+        path = os.path.join(version_dir, name)
+        digest_path = path + ".sha256"
+
+        if os.path.exists(path) and os.path.exists(digest_path):
+            with open(digest_path) as f:
+                recorded = f.read().strip()
+            if file_sha256(path) == recorded:
+                return path
+            logger.warning(f"Cached {path} failed checksum validation, downloading again")
+
+        os.makedirs(version_dir, exist_ok=True)
+        part_path = path + ".part"
+        logger.info(f"Downloading s3://{self.bucket}/{key}")
+        self.s3.download_file(self.bucket, key, part_path)
+
+        digest = file_sha256(part_path)
+        expected = self._published_digest(key)
+        if expected and digest != expected:
+            os.remove(part_path)
+            raise ValueError(f"Checksum mismatch for s3://{self.bucket}/{key}: expected {expected}, got {digest}")
+
+        os.replace(part_path, path)
+        with open(digest_path, "w") as f:
+            f.write(digest)
+        return path
+
+    def _fetch_variant(self, version):
+        """Local path and variant of the model to run for a version"""
+        try:
+            return self.fetch(version, MODEL_VARIANTS[self.variant]), self.variant
+        except ClientError:
+            if self.variant == "fp32":
+                raise
+            logger.warning(f"No {self.variant} model published for version {version}, falling back to fp32")
+        return self.fetch(version, MODEL_VARIANTS["fp32"]), "fp32"
+
+    def _optimized_session(self, version, model_path):
+        name = optimized_model_name(self.profile, os.path.basename(model_path))
+        try:
+            optimized_path = self.fetch(version, name)
+            return create_session(model_path, self.profile, optimized_path)
+        except ClientError:
+            logger.info(f"No published optimized graph {name}, optimizing locally")
+
+        optimized_path = os.path.join(self.cache_dir, version, name)
+        if os.path.exists(optimized_path):
+            os.remove(optimized_path)
+        session = create_session(model_path, self.profile, optimized_path)
+        digest = file_sha256(optimized_path)
+        with open(optimized_path + ".sha256", "w") as f:
+            f.write(digest)
+
+        if PUBLISH_OPTIMIZED:
+            key = f"{self.prefix}/models/{version}/{name}"
+            try:
+                self.s3.upload_file(optimized_path, self.bucket, key)
+                self.s3.put_object(Bucket=self.bucket, Key=key + ".sha256", Body=digest.encode("utf-8"))
+            except Exception as e:
+                logger.warning(f"Could not publish optimized graph to s3://{self.bucket}/{key}: {e}")
+
+        return session
+
+    def load(self, version):
+        model_path, variant = self._fetch_variant(version)
+        labels_path = self.fetch(version, "labels.json")
+
+        session = self._optimized_session(version, model_path)
+        with open(labels_path, "r") as f:
+            labels = json.load(f)
+
+        logger.info(f"Loaded model version {version} ({variant}) with {len(labels)} labels")
+        return LoadedModel(session, labels, version, variant)
+
+    def _prune(self, keep):
+        """Drop cached versions other than the one in use, /tmp is small"""
+        for name in os.listdir(self.cache_dir):
+            if name != keep:
+                shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+
+    def _fresh(self):
+        return self._model is not None and time.monotonic() - self._checked_at < self.check_seconds
+
+    def get(self):
+        """The current model, loading it on first use and swapping it when the published version changes"""
+        if self._fresh():
+            return self._model
+
+        with self._lock:
+            if self._fresh():
+                return self._model
+
+            try:
+                version = self.current_version()
+                if self._model is None or version != self._model.version:
+                    logger.info(f"Using model version: {version}")
+                    self._model = self.load(version)
+                    self._prune(keep=version)
+            except Exception as e:
+                if self._model is None:
+                    raise
+                logger.warning(f"Model refresh failed, keeping version {self._model.version}: {e}")
+
+            self._checked_at = time.monotonic()
+            return self._model
@@ -1,5 +1,6 @@
 import json
 import boto3
+from metrics import invocation
 
 dynamodb = boto3.resource("dynamodb")
 table = dynamodb.Table("BirdTagsData")
@@ -16,6 +17,12 @@ def generate_presigned_url(s3_uri):
     return None
 
 def lambda_handler(event, context):
+    with invocation("thumbnailQueryHandler") as timer:
+        response = find_original(event, timer)
+        timer.set(status_code=response["statusCode"])
+        return response
+
+def find_original(event, timer):
     try:
         if event.get("httpMethod", "").upper() != "POST":
             return {
@@ -33,10 +40,12 @@ def lambda_handler(event, context):
             }
 
         # Full scan — consider GSI for better performance if needed
-        response = table.scan()
+        with timer.stage("dynamodb"):
+            response = table.scan()
         for item in response.get("Items", []):
             if item.get("thumbnail_s3_url") == input_thumb:
-                original_url = generate_presigned_url(item.get("original_s3_url"))
+                with timer.stage("presign"):
+                    original_url = generate_presigned_url(item.get("original_s3_url"))
 
                 return {
                     "statusCode": 200,
@@ -1,52 +1,92 @@
 import boto3
 import os
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from io import BytesIO
+from urllib.parse import unquote_plus
+from metrics import invocation
 
 # Initialize the S3 client
 s3 = boto3.client('s3')
 
-def handler(event, context):
-    print("Thumbnail Lambda triggered!")
+# Thumbnails are mostly S3 round trips, so records are handled side by side
+RECORD_WORKERS = int(os.environ.get('RECORD_WORKERS', '8'))
 
-    # Extract bucket name and object key from the S3 event
-    record = event['Records'][0]
+def create_thumbnail(record, timer):
+    # Extract bucket name and object key from the S3 record
     bucket = record['s3']['bucket']['name']
-    key = record['s3']['object']['key']
+    key = unquote_plus(record['s3']['object']['key'])
 
     # Only handle image files
     if not key.lower().endswith(('.jpg', '.jpeg', '.png')):
         print(f"Unsupported file type: {key}")
-        return {'statusCode': 400, 'body': 'Only image files are supported'}
+        return {'key': key, 'statusCode': 400, 'body': 'Only image files are supported'}
 
     # Download the original image file from S3
-    response = s3.get_object(Bucket=bucket, Key=key)
-    img_data = response['Body'].read()
-    img = Image.open(BytesIO(img_data))
+    with timer.stage('download'):
+        response = s3.get_object(Bucket=bucket, Key=key)
+        img_data = response['Body'].read()
+    timer.value('payload_bytes', len(img_data), 'Bytes')
+
+    with timer.stage('resize'):
+        img = Image.open(BytesIO(img_data))
 
-    # Generate a thumbnail with a maximum size of 256x256
-    img.thumbnail((256, 256))
+        # Generate a thumbnail with a maximum size of 256x256
+        img.thumbnail((256, 256))
 
-    # Save the thumbnail into an in-memory buffer
-    buffer = BytesIO()
-    img_format = img.format if img.format else 'JPEG'
-    img.save(buffer, format=img_format)
-    buffer.seek(0)
+        # Save the thumbnail into an in-memory buffer
+        buffer = BytesIO()
+        img_format = img.format if img.format else 'JPEG'
+        img.save(buffer, format=img_format)
+        buffer.seek(0)
 
     # Define the output S3 key under the 'thumbnails/' folder
     filename = os.path.basename(key)
     thumb_key = f'thumbnails/{filename}'
 
     # Upload the thumbnail image to S3
-    s3.put_object(
-        Bucket=bucket,
-        Key=thumb_key,
-        Body=buffer,
-        ContentType=f'image/{img_format.lower()}'
-    )
+    with timer.stage('upload'):
+        s3.put_object(
+            Bucket=bucket,
+            Key=thumb_key,
+            Body=buffer,
+            ContentType=f'image/{img_format.lower()}'
+        )
 
     print(f"Thumbnail uploaded to: {thumb_key}")
+    return {'key': key, 'statusCode': 200, 'body': f'Thumbnail created at {thumb_key}'}
+
+def safe_create_thumbnail(record):
+    key = record.get('s3', {}).get('object', {}).get('key')
+    with invocation('thumbnails', key=key) as timer:
+        try:
+            result = create_thumbnail(record, timer)
+        except Exception as e:
+            print(f"Thumbnail failed for {key}: {e}")
+            result = {'key': key, 'statusCode': 500, 'body': str(e)}
+        timer.set(status_code=result['statusCode'])
+    return result
+
+def handler(event, context):
+    print("Thumbnail Lambda triggered!")
+
+    records = [record for record in event.get('Records', []) if 's3' in record]
+    workers = max(1, min(RECORD_WORKERS, len(records)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(safe_create_thumbnail, records))
+
+    # S3 invokes this asynchronously, and only a raised error makes Lambda retry;
+    # unsupported files (400) never will work, so they are not retried
+    retry = [result['key'] for result in results if result['statusCode'] >= 500]
+    if retry:
+        raise RuntimeError(f"Thumbnails failed for {retry}: {results}")
+
+    if len(results) == 1:
+        return results[0]
+
+    failed = sum(result['statusCode'] != 200 for result in results)
     return {
-        'statusCode': 200,
-        'body': f'Thumbnail created at {thumb_key}'
-    }
\ No newline at end of file
+        'statusCode': 207 if failed else 200,
+        'body': f'{len(results) - failed} of {len(results)} thumbnails created',
+        'results': results
+    }